@@ -6,14 +6,42 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from itertools import zip_longest, takewhile
+from itertools import zip_longest, takewhile, islice
 from re import sub
+import hashlib
+import os
 import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
 import skbio
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
 from q2_types.feature_data import DNAFASTAFormat
 
 
+# read buffer size used when streaming raw FASTA files
+_FASTA_BUFFER_SIZE = 1 << 20
+
+# IUPAC RNA characters (including gaps) accepted by skbio.RNA, and the table
+# used to reverse transcribe them
+_RNA_CHARS = b'ACGURYSWKMBDHVN-.'
+_RNA_TO_DNA_TABLE = bytes.maketrans(b'U', b'T')
+
+# number of records reverse transcribed at a time
+_RNA_TO_DNA_BATCH_SIZE = 10000
+
+# environment variables that override the default cache location and the
+# maximum cache size (in bytes)
+_CACHE_DIR_ENV = 'RESCRIPT_CACHE_DIR'
+_CACHE_MAX_SIZE_ENV = 'RESCRIPT_CACHE_MAX_SIZE'
+_DEFAULT_CACHE_MAX_SIZE = 2 * 1024 ** 3
+# namespaces of the entries written with _write_cache_entry. Only these are
+# listed and evicted: other files in the cache directory (e.g., the NCBI
+# checkpoint and taxonomy databases, or partial SILVA downloads) are managed
+# by the actions that create them.
+_CACHE_NAMESPACES = ('silva-taxonomy',)
+
 _rank_handles = {
     'silva': [' d__', ' p__', ' c__', ' o__', ' f__', ' g__', ' s__'],
     'greengenes': ['k__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__'],
@@ -26,12 +54,14 @@ _rank_handles = {
 def _find_super_lca(taxa, collapse_substrings=True):
     # collapse and count unique labels at each rank
     # yields list of ('labels', counts) sorted by most to least abundant
-    taxa = [[t for t in r if t not in [None, '']] for r in zip_longest(*taxa)]
+    taxa = [Counter(t for t in r if t not in [None, ''])
+            for r in zip_longest(*taxa)]
     if collapse_substrings:
-        # find longest string in group of sub/superstrings, combine
-        taxa = [[max({i for i in x if t in i}, key=len) for t in x]
-                if x else '' for x in taxa]
-    taxa_comparison = [Counter(t).most_common() for t in taxa]
+        # find longest string in group of sub/superstrings, combine. Only the
+        # unique labels need to be compared, so large clusters of identical
+        # labels stay cheap.
+        taxa = [_collapse_label_counts(x) for x in taxa]
+    taxa_comparison = [t.most_common() for t in taxa]
     # return majority wherever a clear majority is found
     # terminate when no majority is found, that's your LCA
     # propagate empty ranks that maintain majority/consensus by inserting ''
@@ -64,6 +94,141 @@ def _find_lca(taxa):
         lambda x: len(x) == 1, taxa_comparison))
 
 
+def _collapse_substrings(labels):
+    '''
+    Map each label to the longest label in labels that contains it.
+
+    If several labels of that length contain it, the one that comes first in
+    labels is chosen.
+
+    labels: list of str
+        Unique labels.
+
+    Return list of str
+    '''
+    # candidates are checked longest first, so the first container found is
+    # the superstring; the stable sort keeps ties in input order.
+    by_length = sorted(labels, key=len, reverse=True)
+    return [next(i for i in by_length if len(i) >= len(t) and t in i)
+            for t in labels]
+
+
+def _collapse_label_counts(counts):
+    '''Merge label counts into the longest superstring of each label.'''
+    collapsed = Counter()
+    for label, superstring in zip(counts, _collapse_substrings(list(counts))):
+        collapsed[superstring] += counts[label]
+    return collapsed
+
+
+def _find_consensus_batch(taxa, groups, mode='lca'):
+    '''
+    Find consensus taxonomies for many groups of taxonomies at once.
+
+    Labels are encoded as integer codes at each rank once, and consensus is
+    then computed for all groups at once with grouped array operations.
+
+    taxa: list of lists of str
+        Taxonomic labels at each rank, for each taxonomy.
+    groups: array-like
+        Group (e.g., cluster or feature ID) of each taxonomy in taxa.
+    mode: str
+        "lca", "majority", or "super"; results are the same as applying
+        _find_lca, _find_lca_majority, or _find_super_lca to each group.
+
+    Return pd.Series
+        Consensus taxonomy of each group (list of str), indexed by group.
+    '''
+    group_codes, group_ids = pd.factorize(np.asarray(groups, dtype=object))
+    n_groups = len(group_ids)
+    lineage_lens = np.fromiter(
+        (len(t) for t in taxa), dtype=np.int64, count=len(taxa))
+    depth = int(lineage_lens.max()) if len(taxa) else 0
+    # pads shorter lineages with None
+    ranks = pd.DataFrame(list(taxa), columns=range(depth))
+
+    consensus = np.empty((n_groups, depth), dtype=object)
+    found = np.zeros((n_groups, depth), dtype=bool)
+    if mode == 'lca':
+        # LCA ends at the first rank that is either missing from a lineage
+        # or has more than one label in a group. Sort by group so that each
+        # group is a contiguous block that can be reduced in one call.
+        order = np.argsort(group_codes, kind='mergesort')
+        starts = np.flatnonzero(np.diff(group_codes[order], prepend=-1))
+        for r in range(depth):
+            codes, labels = pd.factorize(ranks[r])
+            codes = codes[order]
+            lowest = np.minimum.reduceat(codes, starts)
+            found[:, r] = (lowest >= 0) & (
+                lowest == np.maximum.reduceat(codes, starts))
+            consensus[found[:, r], r] = np.asarray(
+                labels, dtype=object)[lowest[found[:, r]]]
+        depths = np.logical_and.accumulate(found, axis=1).sum(axis=1)
+    else:
+        for r in range(depth):
+            found[:, r], consensus[:, r] = _find_majority_batch(
+                ranks[r], group_codes, n_groups, mode == 'super')
+        depths = np.logical_and.accumulate(found, axis=1).sum(axis=1)
+        # majority consensus never extends past the longest lineage in each
+        # group (empty ranks up to that point are labeled '')
+        max_lens = np.zeros(n_groups, dtype=np.int64)
+        np.maximum.at(max_lens, group_codes, lineage_lens)
+        depths = np.minimum(depths, max_lens)
+    return pd.Series([list(c[:d]) for c, d in zip(consensus, depths)],
+                     index=group_ids, name='Taxon')
+
+
+def _find_majority_batch(labels, group_codes, n_groups, collapse_substrings):
+    # find majority label at a single rank for all groups. Returns an array
+    # indicating whether each group has a clear majority (groups with no
+    # labels at this rank do, and are labeled ''), and the majority labels.
+    codes, uniques = pd.factorize(labels)
+    uniques = np.asarray(uniques, dtype=object)
+    valid = codes >= 0
+    if len(uniques):
+        valid &= uniques[codes] != ''
+    n_codes = max(len(uniques), 1)
+    keys, first, counts = np.unique(
+        group_codes[valid] * n_codes + codes[valid], return_index=True,
+        return_counts=True)
+    groups, codes = np.divmod(keys, n_codes)
+    if collapse_substrings:
+        # collapse labels into superstrings, only considering the unique
+        # labels found within each group. Labels are passed in order of first
+        # occurrence in the group, as in _find_super_lca, so that ties
+        # between superstrings are resolved within each group.
+        bounds = np.flatnonzero(np.diff(groups, prepend=-1, append=-1))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if end - start > 1:
+                group_codes_ = codes[start:end]
+                group_codes_ = group_codes_[np.argsort(first[start:end])]
+                group_labels = list(uniques[group_codes_])
+                code_map = dict(zip(group_labels, group_codes_))
+                supers = dict(zip(group_labels,
+                                  _collapse_substrings(group_labels)))
+                codes[start:end] = [code_map[supers[label]] for label in
+                                    uniques[codes[start:end]]]
+        keys, inverse = np.unique(groups * n_codes + codes,
+                                  return_inverse=True)
+        counts = np.bincount(inverse, weights=counts).astype(np.int64)
+        groups, codes = np.divmod(keys, n_codes)
+    # order by group, then by descending count; the first entry of each group
+    # is the majority label, which must beat the runner-up (if any).
+    order = np.lexsort((-counts, groups))
+    groups, codes, counts = groups[order], codes[order], counts[order]
+    top = np.flatnonzero(np.diff(groups, prepend=-1))
+    runner_up = top + 1
+    contested = runner_up < len(groups)
+    contested[contested] = groups[runner_up[contested]] == groups[
+        top[contested]]
+    majority = np.ones(n_groups, dtype=bool)
+    majority[groups[top]] = ~contested | (
+        counts[top] > counts[np.minimum(runner_up, len(counts) - 1)])
+    labels = np.full(n_groups, '', dtype=object)
+    labels[groups[top]] = uniques[codes[top]]
+    return majority, labels
+
+
 def _rank_length(t1, t2):
     '''Determine which semicolon-delimited string has more elements.'''
     len_first = len(set(t1['Taxon']) - {None, ''})
@@ -83,9 +248,34 @@ def _taxon_to_list(taxon, rank_handle):
         return [t.strip() for t in taxon.split(';')]
 
 
-def _majority(taxon):
-    '''Find most common element in a list'''
-    return max(set(taxon), key=taxon.count)
+def _batched(iterable, n):
+    '''Yield successive lists of up to n items from iterable.'''
+    iterator = iter(iterable)
+    batch = list(islice(iterator, n))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, n))
+
+
+def _parallel_map(func, iterable, processes=1):
+    '''
+    Lazily map func over iterable with a pool of worker processes.
+
+    Results are yielded in input order. At most two tasks per worker are in
+    flight at once, so iterable is consumed incrementally rather than being
+    read into memory up front.
+    '''
+    if processes == 1:
+        yield from map(func, iterable)
+        return
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * processes:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
 
 
 def run_command(cmd, verbose=True):
@@ -107,9 +297,271 @@ def _read_dna_fasta(path):
     return skbio.read(path, format='fasta', constructor=skbio.DNA)
 
 
+def _read_fasta_records(path):
+    '''
+    Stream raw (header, sequence) records from a FASTA file as bytes.
+
+    This bypasses skbio entirely, so no validation is performed: use this
+    only on files that have already been validated as a FASTA format.
+    Headers are returned without the leading '>' and with the ID and
+    description separated by a single space, exactly as skbio writes them.
+    Multi-line sequences are joined into a single line, and whitespace
+    within sequences is removed.
+    '''
+    with open(path, 'rb', buffering=_FASTA_BUFFER_SIZE) as fasta:
+        yield from _parse_fasta_lines(fasta)
+
+
+def _parse_fasta_lines(lines):
+    '''
+    Parse raw (header, sequence) records from lines of FASTA, as bytes.
+
+    Records are formatted as by _read_fasta_records.
+    '''
+    header, seq = None, []
+    for line in lines:
+        if line.startswith(b'>'):
+            if header is not None:
+                yield header, b''.join(seq)
+            header, seq = b' '.join(line[1:].strip().split(None, 1)), []
+        else:
+            # drop spaces within sequences, as skbio does; any other
+            # whitespace (e.g. tabs) is kept, and left for validation to reject
+            line = line.strip().replace(b' ', b'')
+            if line:
+                seq.append(line)
+    if header is not None:
+        yield header, b''.join(seq)
+
+
+def _read_fasta_chunks(path, chunk_size):
+    '''
+    Read a FASTA file in chunks of raw bytes that each hold whole records.
+
+    Chunks are about chunk_size bytes long (longer if a single record does
+    not fit), and are meant to be parsed elsewhere, e.g., by worker
+    processes, with _parse_fasta_lines.
+    '''
+    with open(path, 'rb') as fasta:
+        remainder = b''
+        for block in iter(lambda: fasta.read(chunk_size), b''):
+            remainder += block
+            # split after the last line that ends before a new record
+            end = remainder.rfind(b'\n>') + 1
+            if end:
+                yield remainder[:end]
+                remainder = remainder[end:]
+        if remainder:
+            yield remainder
+
+
+def _write_fasta_record(fh, header, seq):
+    '''Write a raw FASTA record to a file opened in binary mode.'''
+    fh.write(b'>' + header + b'\n' + seq + b'\n')
+
+
+def _get_md5(file, chunksize=8192):
+    md5_hash = hashlib.md5()
+    with open(file, "rb") as f:
+        for chunk in iter(lambda: f.read(chunksize), b""):
+            md5_hash.update(chunk)
+    return md5_hash.hexdigest()
+
+
+def _get_cache_dir(*subdirs):
+    '''
+    Return the path to a RESCRIPt cache directory, creating it if needed.
+
+    The cache lives in ~/.cache/rescript unless the RESCRIPT_CACHE_DIR
+    environment variable is set.
+    '''
+    cache_dir = os.environ.get(_CACHE_DIR_ENV) or os.path.join(
+        os.path.expanduser('~'), '.cache', 'rescript')
+    cache_dir = os.path.join(cache_dir, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _get_cache_max_size():
+    '''Return the maximum cache size, in bytes.'''
+    return int(os.environ.get(_CACHE_MAX_SIZE_ENV, _DEFAULT_CACHE_MAX_SIZE))
+
+
+def _cache_path(namespace, filename):
+    '''Return the path to a cache entry, or None if there is no cache.'''
+    if namespace not in _CACHE_NAMESPACES:
+        raise ValueError('Unknown cache namespace: {0}'.format(namespace))
+    try:
+        return os.path.join(_get_cache_dir(namespace), filename)
+    except OSError:
+        return None
+
+
+def _touch_cache_entry(path):
+    '''Mark a cache entry as recently used.'''
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def _write_cache_entry(path, write, mode='wb'):
+    '''
+    Write a cache entry with write(file handle), then evict stale entries.
+
+    The entry is written to a temporary file first so that concurrent
+    readers never see an incomplete entry. Caching is best-effort, so
+    errors are ignored.
+    '''
+    try:
+        with tempfile.NamedTemporaryFile(
+                mode, dir=os.path.dirname(path), prefix='.tmp',
+                delete=False) as tmp:
+            write(tmp)
+        os.replace(tmp.name, path)
+        _evict_cache()
+    except OSError:
+        pass
+
+
+def _list_cache_entries():
+    '''
+    List the entries in the RESCRIPt cache namespaces (_CACHE_NAMESPACES).
+
+    Return pd.DataFrame
+        The path (relative to the cache directory), size in bytes, and last
+        use (as a UNIX timestamp) of each entry, most recently used first.
+    '''
+    cache_dir = _get_cache_dir()
+    entries = []
+    for namespace in _CACHE_NAMESPACES:
+        dirpath = os.path.join(cache_dir, namespace)
+        try:
+            filenames = os.listdir(dirpath)
+        except OSError:
+            continue
+        for filename in filenames:
+            # skip entries that are being written
+            if filename.startswith('.tmp'):
+                continue
+            path = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((os.path.relpath(path, cache_dir), stat.st_size,
+                            stat.st_mtime))
+    entries = pd.DataFrame(entries, columns=['entry', 'size', 'last_used'])
+    return entries.sort_values(
+        'last_used', ascending=False, kind='mergesort').reset_index(drop=True)
+
+
+def _evict_cache(max_size=None):
+    '''
+    Remove the least recently used cache entries until the cache fits.
+
+    max_size: int
+        Maximum cache size in bytes. Defaults to RESCRIPT_CACHE_MAX_SIZE, or
+        2 GiB.
+
+    Return list of str
+        The removed entries.
+    '''
+    if max_size is None:
+        max_size = _get_cache_max_size()
+    entries = _list_cache_entries()
+    stale = entries['entry'][entries['size'].cumsum() > max_size].tolist()
+    cache_dir = _get_cache_dir()
+    for entry in stale:
+        try:
+            os.remove(os.path.join(cache_dir, entry))
+        except OSError:
+            pass
+    return stale
+
+
+def _save_cached_series(namespace, key, series):
+    '''
+    Cache a pd.Series of str (e.g., a taxonomy).
+
+    Values are stored in a compressed columnar format: the index, plus
+    integer codes into the unique values.
+    '''
+    path = _cache_path(namespace, key + '.npz')
+    if path is None:
+        return
+    codes, uniques = pd.factorize(series)
+    _write_cache_entry(path, lambda fh: np.savez_compressed(
+        fh, ids=np.asarray(series.index, dtype=str), codes=codes,
+        uniques=np.asarray(uniques, dtype=str)))
+
+
+def _load_cached_series(namespace, key):
+    '''Return a Series cached by _save_cached_series, or None.'''
+    path = _cache_path(namespace, key + '.npz')
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            series = pd.Series(data['uniques'].astype(object)[data['codes']],
+                               index=data['ids'].astype(object))
+    except (OSError, ValueError, KeyError):
+        return None
+    _touch_cache_entry(path)
+    return series
+
+
+def _reverse_transcribe_records(path):
+    '''
+    Stream raw (header, sequence) records from an RNA FASTA file, reverse
+    transcribed to DNA.
+
+    Sequences are validated and translated in batches of raw bytes, instead
+    of being loaded as skbio objects.
+    '''
+    for batch in _batched(_read_fasta_records(path), _RNA_TO_DNA_BATCH_SIZE):
+        headers, seqs = zip(*batch)
+        # join the batch so that it is validated/translated in one pass
+        seqs = b'\n'.join(seqs)
+        if seqs.translate(None, _RNA_CHARS + b'\n'):
+            _raise_invalid_rna(headers, seqs.split(b'\n'))
+        yield from zip(headers, seqs.translate(_RNA_TO_DNA_TABLE).split(b'\n'))
+
+
 def _rna_to_dna(path):
+    '''
+    Reverse transcribe an RNA FASTA file into a DNAFASTAFormat.
+
+    Output is identical to writing each reverse transcribed skbio.RNA record
+    with skbio.
+    '''
     ff = DNAFASTAFormat()
-    with ff.open() as outfasta:
-        for seq in _read_rna_fasta(path):
-            seq.reverse_transcribe().write(outfasta)
+    with open(str(ff), 'wb') as outfasta:
+        for header, seq in _reverse_transcribe_records(path):
+            _write_fasta_record(outfasta, header, seq)
     return ff
+
+
+def _rna_to_dna_iterator(path):
+    '''
+    Lazily reverse transcribe an RNA FASTA file, yielding skbio.DNA records
+    as they are read, without writing an intermediate DNA file.
+    '''
+    for header, seq in _reverse_transcribe_records(path):
+        seq_id, _, description = header.decode().partition(' ')
+        # the RNA alphabet was validated, so skip re-validating as DNA
+        yield skbio.DNA(seq, metadata={'id': seq_id,
+                                       'description': description},
+                        validate=False)
+
+
+def _raise_invalid_rna(headers, seqs):
+    for header, seq in zip(headers, seqs):
+        invalid = seq.translate(None, _RNA_CHARS)
+        if invalid:
+            raise ValueError(
+                'Invalid character(s) in RNA sequence {0}: {1}. Valid '
+                'characters: {2}'.format(
+                    header.split(b' ', 1)[0].decode(),
+                    sorted(set(invalid.decode(errors='replace'))),
+                    sorted(_RNA_CHARS.decode())))
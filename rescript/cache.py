@@ -0,0 +1,107 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+'''
+Inspect and manage the RESCRIPt cache.
+
+RESCRIPt caches data that are expensive to recompute (e.g., parsed SILVA
+taxonomies) in ~/.cache/rescript, or in the directory set
+by the RESCRIPT_CACHE_DIR environment variable. Least recently used entries
+are evicted once the cache exceeds RESCRIPT_CACHE_MAX_SIZE bytes (2 GiB by
+default). Other files in the cache directory (the NCBI checkpoint and
+taxonomy databases, and interrupted SILVA downloads) are never evicted, but
+are removed by clear.
+
+Usage: python -m rescript.cache {list,evict,clear}
+'''
+
+import argparse
+import os
+import shutil
+from datetime import datetime
+
+from ._utilities import (_get_cache_dir, _get_cache_max_size,
+                         _list_cache_entries, _evict_cache, _CACHE_NAMESPACES)
+
+# subdirectories of the cache directory that can be cleared
+_CLEARABLE_NAMESPACES = _CACHE_NAMESPACES + ('ncbi', 'silva-downloads')
+
+
+def _format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024 or unit == 'GiB':
+            break
+        size /= 1024
+    return '{0:.1f} {1}'.format(size, unit)
+
+
+def list_cache():
+    '''Print the cache location, size, and entries.'''
+    entries = _list_cache_entries()
+    print('Cache directory: ' + _get_cache_dir())
+    print('Cache size: {0} of {1}'.format(
+        _format_size(entries['size'].sum()),
+        _format_size(_get_cache_max_size())))
+    for entry, size, last_used in entries.itertuples(index=False):
+        print('{0}\t{1}\t{2}'.format(
+            datetime.fromtimestamp(last_used).strftime('%Y-%m-%d %H:%M'),
+            _format_size(size), entry))
+
+
+def evict_cache(max_size=None):
+    '''Remove least recently used entries until the cache fits max_size.'''
+    for entry in _evict_cache(max_size):
+        print('Removed ' + entry)
+
+
+def clear_cache(namespace=None):
+    '''Remove all cache entries, or only those in one namespace.'''
+    if namespace is not None and namespace not in _CLEARABLE_NAMESPACES:
+        raise ValueError('Unknown cache namespace: {0}. Choose from: '
+                         '{1}'.format(namespace,
+                                      ', '.join(_CLEARABLE_NAMESPACES)))
+    cache_dir = _get_cache_dir()
+    if namespace is None:
+        targets = [os.path.join(cache_dir, d) for d in os.listdir(cache_dir)]
+    else:
+        targets = [os.path.join(cache_dir, namespace)]
+    for target in targets:
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.exists(target):
+            os.remove(target)
+    print('Cleared ' + (namespace or 'all') + ' cache entries.')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m rescript.cache',
+        description='Inspect and manage the RESCRIPt cache.')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('list', help='List cache entries (default).')
+    evict = commands.add_parser(
+        'evict', help='Remove least recently used entries until the cache '
+                      'fits within its maximum size.')
+    evict.add_argument('--max-size', type=int, default=None,
+                       help='Maximum cache size in bytes.')
+    clear = commands.add_parser('clear', help='Remove cache entries.')
+    clear.add_argument('namespace', nargs='?', default=None,
+                       choices=_CLEARABLE_NAMESPACES,
+                       help='Only remove entries in this namespace.')
+    args = parser.parse_args(argv)
+
+    if args.command == 'evict':
+        evict_cache(args.max_size)
+    elif args.command == 'clear':
+        clear_cache(args.namespace)
+    else:
+        list_cache()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,10 @@ from sklearn.model_selection import StratifiedKFold
 from q2_feature_classifier._consensus_assignment import (
     _consensus_assignments, _get_default_unassignable_label)
 
-from q2_types.feature_data import DNAFASTAFormat, DNAIterator
+from q2_types.feature_data import DNAFASTAFormat
 
 from .evaluate import _taxonomic_depth, _process_labels
+from ._utilities import _read_fasta_records, _write_fasta_record
 
 
 def evaluate_fit_classifier(ctx,
@@ -203,7 +204,8 @@ def _validate_cross_validate_inputs(taxonomy, sequences):
     # with the current NB classifier; we could relax this if we implement other
     # methods later on for CV classification).
     _validate_even_rank_taxonomy(taxa)
-    seq_ids = {i.metadata['id'] for i in sequences.view(DNAIterator)}
+    seq_ids = {header.split(None, 1)[0].decode() for header, _ in
+               _read_fasta_records(str(sequences.view(DNAFASTAFormat)))}
     _validate_index_is_superset(set(taxa.index), seq_ids)
     return taxa, seq_ids
 
@@ -215,15 +217,21 @@ def _split_fasta(sequences, train_ids, test_ids):
     train_ids: set
     test_ids: set
     '''
+    seq_fp = str(sequences.view(DNAFASTAFormat))
+    train_ids = {seq_id.encode() for seq_id in train_ids}
+    test_ids = {seq_id.encode() for seq_id in test_ids}
     train_seqs = DNAFASTAFormat()
     test_seqs = DNAFASTAFormat()
-    with train_seqs.open() as _train, test_seqs.open() as _test:
-        for s in sequences.view(DNAIterator):
-            _id = s.metadata['id']
-            if s.metadata['id'] in train_ids:
-                _train.write('>%s\n%s\n' % (_id, str(s)))
-            elif s.metadata['id'] in test_ids:
-                _test.write('>%s\n%s\n' % (_id, str(s)))
+    # write both splits in a single pass over the sequences
+    with open(str(train_seqs), 'wb') as train_fasta, \
+            open(str(test_seqs), 'wb') as test_fasta:
+        for header, seq in _read_fasta_records(seq_fp):
+            # only write sequence IDs, dropping any descriptions
+            seq_id = header.split(None, 1)[0]
+            if seq_id in train_ids:
+                _write_fasta_record(train_fasta, seq_id, seq)
+            if seq_id in test_ids:
+                _write_fasta_record(test_fasta, seq_id, seq)
     train_seqs = q2.Artifact.import_data('FeatureData[Sequence]', train_seqs)
     test_seqs = q2.Artifact.import_data('FeatureData[Sequence]', test_seqs)
     return train_seqs, test_seqs
@@ -6,18 +6,98 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-from q2_types.feature_data import (DNAFASTAFormat, AlignedDNAIterator)
+import numpy as np
+from q2_types.feature_data import DNAFASTAFormat, AlignedDNAFASTAFormat
 
+from ._utilities import _read_fasta_records, _write_fasta_record
 
-def degap_seqs(aligned_sequences:
-               AlignedDNAIterator,
+
+# gaps ('-') and missing data ('.') characters
+_GAP_CHARS = b'-.'
+_GAP_LUT = np.zeros(256, dtype=bool)
+_GAP_LUT[np.frombuffer(_GAP_CHARS, dtype=np.uint8)] = True
+
+
+def degap_seqs(aligned_sequences: AlignedDNAFASTAFormat,
                min_length: int = 1) -> DNAFASTAFormat:
     result = DNAFASTAFormat()
-    with result.open() as out_fasta:
-        for seq in aligned_sequences:
-            dg_seq = seq.degap()
+    # stream raw records and delete gap chars at the byte level; this avoids
+    # creating skbio objects (and their gap masks) for every record.
+    with open(str(result), 'wb') as out_fasta:
+        for header, seq in _read_fasta_records(str(aligned_sequences)):
+            dg_seq = seq.translate(None, _GAP_CHARS)
             #  If seq is all gaps, then dg_seq will be an empty string
             #  and we'll not write it out.
             if len(dg_seq) >= min_length:
-                dg_seq.write(out_fasta)
+                _write_fasta_record(out_fasta, header, dg_seq)
+    return result
+
+
+def _profile_alignment_gaps(aligned_sequences_fp):
+    '''
+    Count gap characters in every column of an alignment.
+
+    The alignment is streamed record-by-record, so only a single record and
+    a compact per-column count array are ever held in memory.
+
+    Return (np.ndarray of uint32, int)
+        Gap count for each column, and number of records in the alignment.
+    '''
+    gap_counts = None
+    n_records = 0
+    for header, seq in _read_fasta_records(aligned_sequences_fp):
+        if gap_counts is None:
+            gap_counts = np.zeros(len(seq), dtype=np.uint32)
+        elif len(seq) != len(gap_counts):
+            raise ValueError(
+                'All sequences in an alignment must be the same length. '
+                'Sequence {0} is {1} characters long, but the alignment is '
+                '{2} columns wide.'.format(header.split()[0].decode(),
+                                           len(seq), len(gap_counts)))
+        gap_counts += _GAP_LUT[np.frombuffer(seq, dtype=np.uint8)]
+        n_records += 1
+    if gap_counts is None:
+        gap_counts = np.zeros(0, dtype=np.uint32)
+    return gap_counts, n_records
+
+
+def trim_alignment_columns(aligned_sequences: AlignedDNAFASTAFormat,
+                           max_gap_frequency: float = None,
+                           position_start: int = None,
+                           position_end: int = None) -> AlignedDNAFASTAFormat:
+    if max_gap_frequency is position_start is position_end is None:
+        raise ValueError('No trimming criteria were applied! Set '
+                         'max_gap_frequency, position_start, and/or '
+                         'position_end.')
+    aligned_fp = str(aligned_sequences)
+    # first pass: profile gaps in each column
+    gap_counts, n_records = _profile_alignment_gaps(aligned_fp)
+    width = len(gap_counts)
+    # select columns to keep
+    keep = np.ones(width, dtype=bool)
+    if position_start is not None or position_end is not None:
+        start = 1 if position_start is None else position_start
+        end = width if position_end is None else position_end
+        if start > end or start > width:
+            raise ValueError(
+                'Invalid trimming positions: position_start ({0}) must not '
+                'be greater than position_end ({1}) or the alignment width '
+                '({2}).'.format(start, end, width))
+        keep[:start - 1] = False
+        keep[end:] = False
+    if max_gap_frequency is not None and n_records > 0:
+        keep &= gap_counts / n_records <= max_gap_frequency
+    columns = np.flatnonzero(keep)
+    print('Alignment columns retained: {0} of {1}'.format(len(columns),
+                                                          width))
+    if len(columns) == 0:
+        raise ValueError('All alignment columns were trimmed, resulting in '
+                         'an empty alignment. Adjust max_gap_frequency, '
+                         'position_start, and/or position_end.')
+    # second pass: stream the trimmed records out
+    result = AlignedDNAFASTAFormat()
+    with open(str(result), 'wb') as out_fasta:
+        for header, seq in _read_fasta_records(aligned_fp):
+            trimmed = np.frombuffer(seq, dtype=np.uint8)[columns]
+            _write_fasta_record(out_fasta, header, trimmed.tobytes())
     return result
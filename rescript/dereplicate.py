@@ -7,14 +7,19 @@
 # ----------------------------------------------------------------------------
 
 import tempfile
+import numpy as np
 import pandas as pd
-import skbio
 import shutil
 
+from pandas.api.types import union_categoricals
 from q2_types.feature_data import DNAFASTAFormat
 
-from ._utilities import (run_command, _find_lca, _majority, _rank_handles,
-                         _find_super_lca)
+from ._utilities import (run_command, _rank_handles, _find_consensus_batch,
+                         _read_fasta_records, _write_fasta_record)
+
+
+# number of UC lines parsed at a time
+_UC_CHUNK_SIZE = 100000
 
 
 def dereplicate(sequences: DNAFASTAFormat,
@@ -44,9 +49,12 @@ def dereplicate(sequences: DNAFASTAFormat,
                 out_uc.seek(0)
 
                 # re-map derep centroids to cluster centroids
-                uc_clust = _parse_uc(out_uc.name).set_index('seqID')
-                uc['centroidID'] = uc['centroidID'].apply(
-                    lambda x: uc_clust.loc[x, 'centroidID'])
+                uc_clust = _parse_uc(out_uc.name)
+                uc_clust = pd.Series(np.asarray(uc_clust['centroidID']),
+                                     index=np.asarray(uc_clust['seqID']))
+                uc['centroidID'] = pd.Categorical(
+                    _map_ids(uc['centroidID'], uc_clust),
+                    categories=uc['seqID'].cat.categories)
             else:
                 shutil.copyfile(out_fasta.name, str(clustered_seqs))
 
@@ -97,24 +105,75 @@ def _vsearch_cluster_size(sequences_fp, perc_identity, out_fasta_fp, out_uc_fp,
     run_command(cmd)
 
 
-def _parse_uc(uc_fp):
-    uc = pd.read_csv(uc_fp, sep='\t', header=None, dtype=object)
-    # grab hit and centroid IDs
-    uc = uc[uc[0].isin(['H', 'S'])][[8, 9]]
-    # centroid entries have no centroid ID; so list their own seq ID
-    uc.loc[uc[9] == '*', 9] = uc[8]
-    uc.columns = ['seqID', 'centroidID']
-    return uc
+def _iter_uc(uc_fp, chunksize=_UC_CHUNK_SIZE):
+    '''
+    Stream hit and centroid records from a vsearch UC file.
+
+    Only the record type, query and target columns are parsed, and cluster
+    (C) records are dropped as each chunk is read.
+
+    Yields DataFrames with columns seqID and centroidID.
+    '''
+    for chunk in pd.read_csv(uc_fp, sep='\t', header=None, dtype=str,
+                             usecols=[0, 8, 9], chunksize=chunksize):
+        chunk = chunk[chunk[0].isin(['H', 'S'])]
+        # centroid entries have no centroid ID; so list their own seq ID
+        yield pd.DataFrame({
+            'seqID': chunk[8].values,
+            'centroidID': chunk[9].where(chunk[9] != '*', chunk[8]).values})
+
+
+def _parse_uc(uc_fp, chunksize=_UC_CHUNK_SIZE):
+    '''
+    Parse hit and centroid IDs from a vsearch UC file.
+
+    IDs are stored as categoricals sharing the same categories, so each ID
+    string is held in memory once and IDs can be compared by code.
+    '''
+    seq_ids, centroid_ids = [], []
+    for chunk in _iter_uc(uc_fp, chunksize=chunksize):
+        seq_ids.append(pd.Categorical(chunk['seqID']))
+        centroid_ids.append(pd.Categorical(chunk['centroidID']))
+    seq_ids = union_categoricals(seq_ids, sort_categories=True)
+    centroid_ids = union_categoricals(centroid_ids, sort_categories=True)
+    categories = seq_ids.categories.union(centroid_ids.categories)
+    return pd.DataFrame({
+        'seqID': seq_ids.set_categories(categories),
+        'centroidID': centroid_ids.set_categories(categories)})
+
+
+def _map_ids(ids, mapping):
+    '''
+    Map categorical IDs to the values of an ID-indexed Series.
+
+    All IDs must be in the index of mapping: use _validate_ids_in_taxa first
+    when mapping to a taxonomy.
+    '''
+    return mapping.reindex(ids.cat.categories).values[ids.cat.codes]
+
+
+def _validate_ids_in_taxa(ids, taxa):
+    '''
+    Validate that all categorical IDs are in the index of taxa.
+    ids: pd.Series of categorical
+    taxa: pd.DataFrame
+    '''
+    missing = ids.cat.categories.difference(taxa.index)
+    if len(missing) > 0:
+        raise ValueError('The following IDs are missing from the taxonomy: ' +
+                         ', '.join(missing))
 
 
 def _dereplicate_taxa(taxa, raw_seqs, derep_seqs, uc, mode):
+    # seqID and centroidID share the same categories, i.e., all sequence IDs
+    _validate_ids_in_taxa(uc['seqID'], taxa)
     # we only want to grab hits for uniq mode
     if mode == 'uniq':
         centroid_ids = set(uc['centroidID'].unique())
         uc = uc[uc['seqID'] != uc['centroidID']]
     # map to taxonomy labels
-    uc['Taxon'] = uc['seqID'].apply(lambda x: taxa.loc[x])
-    uc['centroidtaxa'] = uc['centroidID'].apply(lambda x: taxa.loc[x])
+    uc['Taxon'] = _map_ids(uc['seqID'], taxa['Taxon'])
+    uc['centroidtaxa'] = _map_ids(uc['centroidID'], taxa['Taxon'])
 
     if mode == 'uniq':
         # filter out hits that do not match centroid taxonomy
@@ -125,28 +184,30 @@ def _dereplicate_taxa(taxa, raw_seqs, derep_seqs, uc, mode):
         rereplicate_ids = centroid_ids.union(rereplicates['seqID'].unique())
         # write out seqs for centroids and daughters with unique taxonomies
         seqs_out = DNAFASTAFormat()
-        with seqs_out.open() as out_fasta:
-            seq_fp = str(raw_seqs)
-            for s in skbio.read(seq_fp, format='fasta', constructor=skbio.DNA):
-                if s.metadata['id'] in rereplicate_ids:
-                    s.write(out_fasta)
+        keep_ids = {seq_id.encode() for seq_id in rereplicate_ids}
+        with open(str(seqs_out), 'wb') as out_fasta:
+            for header, seq in _read_fasta_records(str(raw_seqs)):
+                if header.split(None, 1)[0] in keep_ids:
+                    _write_fasta_record(out_fasta, header, seq)
         # generate list of dereplicated taxa
         derep_taxa = taxa.reindex(rereplicate_ids)
 
     else:
-        # group seqs that share centroids (this includes the centroid)
-        derep_taxa = uc.groupby('centroidID')['Taxon'].apply(lambda x: list(x))
-        # find LCA within each cluster
-        if mode == 'lca':
-            derep_taxa = derep_taxa.apply(lambda x: ';'.join(
-                _find_lca([y.split(';') for y in x]))).to_frame()
-        # find majority superset LCA within each cluster
-        elif mode == 'super':
-            derep_taxa = derep_taxa.apply(lambda x: ';'.join(
-                _find_super_lca([y.split(';') for y in x]))).to_frame()
-        # find majority taxon within each cluster
-        elif mode == 'majority':
-            derep_taxa = derep_taxa.apply(lambda x: _majority(x)).to_frame()
+        # plain centroid IDs for the output index
+        uc['centroidID'] = np.asarray(uc['centroidID'])
+        # find majority taxon within each cluster (this includes the
+        # centroid); in the event of a tie, the winner is arbitrary.
+        if mode == 'majority':
+            derep_taxa = uc.groupby(['centroidID', 'Taxon']).size()
+            derep_taxa = derep_taxa.reset_index(name='count').sort_values(
+                'count', ascending=False, kind='mergesort').drop_duplicates(
+                'centroidID').set_index('centroidID')[['Taxon']].sort_index()
+        # find LCA or majority superset LCA within each cluster, for all
+        # clusters at once
+        else:
+            derep_taxa = _find_consensus_batch(
+                [t.split(';') for t in uc['Taxon']], uc['centroidID'],
+                mode=mode).apply(';'.join).sort_index().to_frame()
         # LCA and majority do nothing with the seqs
         seqs_out = derep_seqs
 
@@ -6,11 +6,28 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import hashlib
+from array import array
+from collections import OrderedDict
+from re import escape
+
 import qiime2
+import numpy as np
 import pandas as pd
-from q2_types.feature_data import DNAFASTAFormat, DNAIterator
+from q2_types.feature_data import DNAFASTAFormat
+
+from ._utilities import (run_command, _read_fasta_records,
+                         _write_fasta_record)
 
-from ._utilities import run_command
+# taxonomy search indices built by filter_taxa, by taxonomy hash. These are
+# held in memory, so they are only reused within one Python process (e.g., a
+# Python API session), not across separate CLI calls.
+_TAXONOMY_INDEX_CACHE = OrderedDict()
+_TAXONOMY_INDEX_CACHE_SIZE = 4
+# number of search results kept per taxonomy index
+_TAXONOMY_MATCHES_CACHE_SIZE = 32
+# number of bins in the sequence length histogram of filter_seqs_length
+_LENGTH_HISTOGRAM_BINS = 10
 
 ERROR_FILTER_OPTIONS = (
     'No filters were applied. One or more of the following filter settings '
@@ -20,24 +37,90 @@ ERROR_FILTER_OPTIONS = (
 def filter_seqs_length(sequences: DNAFASTAFormat,
                        global_min: int = None,
                        global_max: int = None,
-                       threads: int = 1) -> (DNAFASTAFormat, DNAFASTAFormat):
+                       threads: int = 1,
+                       engine: str = 'vsearch',
+                       length_summary: bool = False
+                       ) -> (DNAFASTAFormat, DNAFASTAFormat):
     # Validate filtering options
     if global_min is global_max is None:
         raise ValueError(ERROR_FILTER_OPTIONS + 'global_min, global_max.')
-    # Filter with vsearch (for global filtering alone, this should be quick)
     result = DNAFASTAFormat()
     failures = DNAFASTAFormat()
-    cmd = ['vsearch', '--fastx_filter', str(sequences), '--fastaout',
-           str(result), '--fastaout_discarded', str(failures),
-           '--threads', str(threads)]
-    if global_min is not None:
-        cmd.extend(['--fastq_minlen', str(global_min)])
-    if global_max is not None:
-        cmd.extend(['--fastq_maxlen', str(global_max)])
-    run_command(cmd)
+    # Filter in-process, streaming raw records
+    if engine == 'native':
+        lengths = _filter_seqs_length_native(
+            str(sequences), str(result), str(failures), global_min,
+            global_max, record_lengths=length_summary)
+    # Filter with vsearch (for global filtering alone, this should be quick)
+    else:
+        cmd = ['vsearch', '--fastx_filter', str(sequences), '--fastaout',
+               str(result), '--fastaout_discarded', str(failures),
+               '--threads', str(threads)]
+        if global_min is not None:
+            cmd.extend(['--fastq_minlen', str(global_min)])
+        if global_max is not None:
+            cmd.extend(['--fastq_maxlen', str(global_max)])
+        run_command(cmd)
+        if length_summary:
+            lengths = np.array(
+                [len(seq) for _, seq in _read_fasta_records(str(sequences))],
+                dtype=np.int64)
+    if length_summary:
+        _print_length_summary(lengths, global_min, global_max)
     return result, failures
 
 
+def _filter_seqs_length_native(sequences_fp, result_fp, failures_fp,
+                               global_min, global_max, record_lengths=False):
+    '''
+    Split sequences into those within and outside of a length range.
+
+    Records are streamed as raw bytes and written out unwrapped.
+
+    Return np.ndarray or None
+        The length of each input sequence, if record_lengths is True.
+    '''
+    minlen = 0 if global_min is None else global_min
+    maxlen = float('inf') if global_max is None else global_max
+    lengths = array('l')
+    with open(result_fp, 'wb') as out_fasta, \
+            open(failures_fp, 'wb') as out_failed:
+        for header, seq in _read_fasta_records(sequences_fp):
+            seqlen = len(seq)
+            if record_lengths:
+                lengths.append(seqlen)
+            if minlen <= seqlen <= maxlen:
+                _write_fasta_record(out_fasta, header, seq)
+            else:
+                _write_fasta_record(out_failed, header, seq)
+    if record_lengths:
+        return np.array(lengths, dtype=np.int64)
+
+
+def _print_length_summary(lengths, global_min, global_max,
+                          bins=_LENGTH_HISTOGRAM_BINS):
+    '''
+    Print the number of sequences retained by length filtering, and a
+    histogram of the input sequence lengths.
+
+    Bins span whole lengths, and are labeled by their (inclusive) range.
+    '''
+    minlen = 0 if global_min is None else global_min
+    maxlen = float('inf') if global_max is None else global_max
+    retained = np.count_nonzero((lengths >= minlen) & (lengths <= maxlen))
+    print('Sequences retained: {0} of {1}'.format(retained, len(lengths)))
+    if not len(lengths):
+        return
+    edges = np.unique(np.linspace(
+        lengths.min(), lengths.max() + 1, bins + 1).astype(np.int64))
+    counts, _ = np.histogram(lengths, bins=edges)
+    print('Sequence length histogram (length: count):')
+    for start, end, count in zip(edges[:-1], edges[1:], counts):
+        label = str(start) if end - 1 == start else '{0}-{1}'.format(
+            start, end - 1)
+        print('{0}: {1}'.format(label, count))
+
+
 def filter_seqs_length_by_taxon(sequences: DNAFASTAFormat,
                                 taxonomy: pd.Series,
                                 labels: str,
@@ -50,12 +133,6 @@ def filter_seqs_length_by_taxon(sequences: DNAFASTAFormat,
     if min_lens is max_lens is None:
         raise ValueError(ERROR_FILTER_OPTIONS + 'min_lens, max_lens.')
 
-    # validate that all seqIDs are present in taxonomy
-    # Note we view as DNAIterator to take a first pass (should take a few
-    # seconds) as initial validation before performing length filtering.
-    seq_ids = {i.metadata['id'] for i in sequences.view(DNAIterator)}
-    _index_is_superset(seq_ids, set(taxonomy.index))
-
     # set filter options
     mins = maxs = None
     if min_lens is not None:
@@ -72,33 +149,36 @@ def filter_seqs_length_by_taxon(sequences: DNAFASTAFormat,
         else:
             maxs = {k: v for k, v in zip(labels, max_lens)}
 
-    # Stream seqs, apply filter(s)
+    # find the length thresholds once per unique taxonomy string, rather than
+    # searching each sequence's taxonomy for every label
+    taxon_codes, taxa = pd.factorize(taxonomy)
+    minlens, maxlens = _taxon_length_thresholds(
+        pd.Series(taxa), labels, mins, maxs, global_min, global_max)
+    taxon_codes = dict(zip(taxonomy.index, taxon_codes))
+
+    # Stream seqs, apply filter(s) in a single pass. All seqIDs must be
+    # present in the taxonomy, so we collect any that are missing as we go.
+    missing = set()
     result = DNAFASTAFormat()
     failures = DNAFASTAFormat()
-    with result.open() as out_fasta, failures.open() as out_failed:
-        for seq in sequences.view(DNAIterator):
-            # taxon is required, we always use taxon-based filtering
-            # grab taxon affiliation for seq
-            taxon = taxonomy[seq.metadata['id']]
-            # search taxon for filter terms
-            # NOTE: we find all matching search terms and pass them all to
-            # _seq_length_within_range below; that function determines and
-            # applies the most stringent matching length thresholds.
-            taxahits = [t for t in labels if t in taxon]
-            # if there are no taxahits or global filters, just write out
-            if not any(taxahits) and global_min is global_max is None:
-                seq.write(out_fasta)
-            # if there are taxahits or global filters, always check length
-            elif _seq_length_within_range(seq, taxahits, mins, maxs,
-                                          global_min, global_max):
-                seq.write(out_fasta)
+    with open(str(result), 'wb') as out_fasta, \
+            open(str(failures), 'wb') as out_failed:
+        for header, seq in _read_fasta_records(str(sequences)):
+            seq_id = header.split(None, 1)[0].decode()
+            code = taxon_codes.get(seq_id)
+            if code is None:
+                missing.add(seq_id)
+            elif maxlens[code] >= len(seq) >= minlens[code]:
+                _write_fasta_record(out_fasta, header, seq)
             else:
-                seq.write(out_failed)
+                _write_fasta_record(out_failed, header, seq)
+    _index_is_superset(missing, taxon_codes)
     return result, failures
 
 
 def filter_taxa(taxonomy: pd.Series, ids_to_keep: qiime2.Metadata = None,
-                include: str = None, exclude: str = None) -> pd.Series:
+                include: str = None, exclude: str = None,
+                rank_handle: str = None) -> pd.Series:
     if include is exclude is ids_to_keep is None:
         raise ValueError('No filtering criteria were applied!')
 
@@ -109,33 +189,128 @@ def filter_taxa(taxonomy: pd.Series, ids_to_keep: qiime2.Metadata = None,
         ids_to_keep = ids_to_keep.ids
         _index_is_superset(set(ids_to_keep), ids)
 
-    if include:
-        ids = ids[taxonomy.str.contains('|'.join(include))]
-
-    if exclude:
-        bad = taxonomy.index[taxonomy.str.contains('|'.join(exclude))]
-        ids = ids.difference(bad)
+    # filtering is set algebra over bitmaps of the features in taxonomy;
+    # search terms are matched against a (cached) index of unique labels.
+    keep = np.ones(len(ids), dtype=bool)
+    if include or exclude:
+        index = _get_taxonomy_index(taxonomy)
+        if include:
+            keep &= _search_taxonomy_index(index, include, rank_handle)
+        if exclude:
+            keep &= ~_search_taxonomy_index(index, exclude, rank_handle)
 
     # if not using exclude or include, we only want explicit ids_to_keep
     if include is exclude is None:
-        ids = ids_to_keep
+        keep = ids.isin(ids_to_keep)
     # otherwise add back ids_to_keep for explicit inclusion after filtering
     elif ids_to_keep:
-        ids = ids.union(ids_to_keep)
+        keep |= ids.isin(ids_to_keep)
 
-    filtered_ids = len(ids)
+    filtered_ids = keep.sum()
     print('Output features: ' + str(filtered_ids))
 
     if filtered_ids == 0:
         raise ValueError("All features were filtered, resulting in an "
                          "empty collection of taxonomies.")
 
-    taxonomy = taxonomy.reindex(ids)
+    taxonomy = taxonomy[keep]
     taxonomy.index.name = 'Feature ID'
 
     return taxonomy
 
 
+def _get_taxonomy_index(taxonomy):
+    '''
+    Return the search index of a taxonomy, building it if it is not cached.
+
+    Indices are cached in memory by a hash of the taxonomy (IDs and labels),
+    so repeated searches of the same taxonomy within one Python process
+    (e.g., a Python API session) reuse the index. Separate CLI calls run in
+    separate processes, and always build a new index.
+    '''
+    key = hashlib.md5(
+        pd.util.hash_pandas_object(taxonomy).values).hexdigest()
+    index = _TAXONOMY_INDEX_CACHE.pop(key, None)
+    if index is None:
+        index = _build_taxonomy_index(taxonomy)
+    # keep the most recently used indices
+    _TAXONOMY_INDEX_CACHE[key] = index
+    while len(_TAXONOMY_INDEX_CACHE) > _TAXONOMY_INDEX_CACHE_SIZE:
+        _TAXONOMY_INDEX_CACHE.popitem(last=False)
+    return index
+
+
+def _build_taxonomy_index(taxonomy):
+    '''
+    Index the unique taxonomy strings of a taxonomy.
+
+    taxonomy: pd.Series
+        Taxonomy strings, indexed by feature ID.
+
+    Return dict
+        codes: the unique taxonomy string of each feature.
+        taxa: the unique taxonomy strings.
+        ranks: per-rank label indices, built on demand (see _rank_labels).
+        matches: search results for each unique taxonomy string, by
+            (terms, rank_handle), for the most recent searches.
+    '''
+    codes, taxa = pd.factorize(taxonomy)
+    return {'codes': codes, 'taxa': pd.Series(taxa, dtype=object),
+            'ranks': {}, 'matches': OrderedDict()}
+
+
+def _rank_labels(index, rank_handle):
+    '''
+    Return the unique labels found at one rank, and the code of the label
+    found in each unique taxonomy string (-1 if the rank is absent).
+
+    Ranks are identified by the rank handle that prefixes their labels,
+    e.g., "g__".
+    '''
+    rank_handle = rank_handle.strip()
+    if rank_handle not in index['ranks']:
+        labels = index['taxa'].str.extract(
+            r'(?:^|;)\s*({0}[^;]*)'.format(escape(rank_handle)),
+            expand=False).str.strip()
+        codes, labels = pd.factorize(labels)
+        index['ranks'][rank_handle] = (pd.Series(labels, dtype=object), codes)
+    return index['ranks'][rank_handle]
+
+
+def _search_taxonomy_index(index, terms, rank_handle=None):
+    '''
+    Find features whose taxonomy matches any of the search terms.
+
+    index: dict
+        Taxonomy index, see _build_taxonomy_index.
+    terms: list of str
+        Search terms (regular expressions).
+    rank_handle: str
+        Only match labels at the rank with this rank handle. By default,
+        terms are matched against full taxonomy strings.
+
+    Return np.ndarray of bool
+        Bitmap of matching features.
+    '''
+    key = (tuple(terms), rank_handle)
+    matches = index['matches'].pop(key, None)
+    if matches is None:
+        pattern = '|'.join(terms)
+        if rank_handle is None:
+            matches = index['taxa'].str.contains(pattern).values
+        else:
+            labels, codes = _rank_labels(index, rank_handle)
+            # features without a label at this rank (code -1) never match
+            matches = np.append(
+                labels.str.contains(pattern).values, False)[codes]
+        matches = matches.astype(bool)
+    # keep the most recent search results
+    index['matches'][key] = matches
+    while len(index['matches']) > _TAXONOMY_MATCHES_CACHE_SIZE:
+        index['matches'].popitem(last=False)
+    return matches[index['codes']]
+
+
 def _seq_length_within_range(sequence, taxahits, mins, maxs, global_min,
                              global_max):
     '''
@@ -187,6 +362,45 @@ def _seq_length_within_range(sequence, taxahits, mins, maxs, global_min,
     return maxlen >= seqlen >= minlen
 
 
+def _taxon_length_thresholds(taxa, labels, mins, maxs, global_min,
+                             global_max):
+    '''
+    Find the most stringent length thresholds for each taxonomy string.
+
+    Each label is searched for in all taxa at once. Thresholds from multiple
+    matching labels are combined as in _seq_length_within_range.
+
+    taxa: pd.Series of str
+        Taxonomy strings.
+    labels: list of str
+        taxonomic labels to search for.
+    mins, maxs, global_min, global_max:
+        As for _seq_length_within_range.
+
+    Return tuple of lists
+        The minimum and maximum length for each taxon (max is inf where no
+        maximum applies).
+    '''
+    minlens = np.zeros(len(taxa), dtype=np.int64)
+    maxlens = np.full(len(taxa), np.inf)
+    # max thresholds are ignored unless at least one of them is non-zero
+    has_max = np.zeros(len(taxa), dtype=bool)
+    for label in labels:
+        hits = taxa.str.contains(label, regex=False).values
+        if mins is not None:
+            minlens[hits] = np.maximum(minlens[hits], mins[label])
+        if maxs is not None:
+            maxlens[hits] = np.minimum(maxlens[hits], maxs[label])
+            has_max |= hits & bool(maxs[label])
+    if global_min is not None:
+        minlens = np.maximum(minlens, global_min)
+    if global_max is not None:
+        maxlens = np.minimum(maxlens, global_max)
+        has_max |= bool(global_max)
+    maxlens[~has_max] = np.inf
+    return minlens.tolist(), maxlens.tolist()
+
+
 def _index_is_superset(index1, index2):
     '''
     Validate that index1 is a subset of index2.
@@ -7,28 +7,39 @@
 # ----------------------------------------------------------------------------
 
 import os
+import pathlib
 import tempfile
 import hashlib
 import shutil
 import gzip
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import qiime2
-from urllib.request import urlretrieve
-from urllib.error import HTTPError
-from .types._format import RNAFASTAFormat
+from urllib.request import urlretrieve, urlopen, Request
+from urllib.error import HTTPError, URLError
+from .types._format import RNAFASTAFormat, RNASequencesDirectoryFormat
+from ._utilities import _get_cache_dir
+
+
+_SILVA_BASE_URL = 'https://www.arb-silva.de/fileadmin/silva_databases/'
+
+# size of the chunks streamed to disk while downloading
+_DOWNLOAD_CHUNK_SIZE = 1 << 20
 
 
 def get_silva_data(ctx,
                    version='138',
                    target='SSURef_NR99',
                    include_species_labels=False,
-                   download_sequences=True):
+                   download_sequences=True,
+                   mirror=None):
     # download data from SILVA
     print('Downloading raw files may take some time... get some coffee.')
     queries = _assemble_silva_data_urls(version, target, download_sequences)
-    results = _retrieve_data_from_silva(queries)
-    # parse taxonomy
+    results = _retrieve_data_from_silva(queries, mirror=mirror)
+    # parse taxonomy (parse_silva_taxonomy reuses previously parsed taxonomies
+    # from the RESCRIPt cache)
     parse_taxonomy = ctx.get_action('rescript', 'parse_silva_taxonomy')
     taxonomy, = parse_taxonomy(
         taxonomy_tree=results['taxonomy tree'],
@@ -54,8 +65,7 @@ def _assemble_silva_data_urls(version, target, download_sequences=True):
         target = 'SSURef_Nr99'
     insert = ref_map[target]
     # now compile URLs
-    base_url = 'https://www.arb-silva.de/fileadmin/silva_databases/'\
-               'release_{0}/Exports/'.format(version)
+    base_url = _SILVA_BASE_URL + 'release_{0}/Exports/'.format(version)
     base_url_seqs = base_url + 'SILVA_{0}_{1}_tax_silva.fasta.gz'.format(
         version, target)
     base_url_taxmap = '{0}taxonomy/taxmap_slv_{1}_{2}'.format(
@@ -86,48 +96,215 @@ def _assemble_silva_data_urls(version, target, download_sequences=True):
     return queries
 
 
-def _retrieve_data_from_silva(queries):
+def _retrieve_data_from_silva(queries, mirror=None):
     '''
     Download data from SILVA, given a list of queries.
 
+    Files are downloaded concurrently into a persistent download directory,
+    so that interrupted downloads resume where they left off when re-run.
+
     queries: list of tuples of (str, str, str)
         (name, urlpath, QIIME 2 artifact type)
+    mirror: str
+        Local directory or URL to download the files from instead of SILVA.
+        Must mirror the directory structure of the SILVA databases.
     '''
+    download_dir = _get_cache_dir('silva-downloads')
+    with ThreadPoolExecutor(max_workers=max(len(queries), 1)) as executor:
+        downloads = list(executor.map(
+            lambda q: _download_silva_file(q[1], download_dir, mirror),
+            queries))
     results = dict()
     with tempfile.TemporaryDirectory() as tmpdirname:
-        for name, query, dtype in queries:
-            print('retrieving {0} from: {1}'.format(name, query))
-            # grab url
-            destination = os.path.join(tmpdirname, os.path.basename(query))
-            urlretrieve(query, destination)
-            file_md5 = _get_md5(destination)
-            # grab expected md5
-            # NOTE: SILVA is missing md5s for some files, so we will just skip
-            try:
-                md5_destination = os.path.join(tmpdirname, 'md5')
-                urlretrieve(query + '.md5', md5_destination)
-                exp_md5 = _read_silva_md5(md5_destination)
-                # validate md5 checksum
-                _validate_md5(exp_md5, file_md5, query)
-            # if we get an HTTPError just move on, the md5 file does not exist
-            except HTTPError:
-                msg = ("No md5 file was detected in the SILVA archive for the "
-                       "following file. No action is required, but be aware "
-                       "that md5-hash validation was not performed for this "
-                       "file: " + query)
-                warnings.warn(msg, UserWarning)
-            # gunzip on demand (SILVA releases are inconsistently gzipped)
-            try:
-                unzipped_destination = os.path.splitext(destination)[0]
-                _gzip_decompress(destination, unzipped_destination)
-                destination = unzipped_destination
-            except OSError:
-                pass
-            # import as artifacts
-            results[name] = qiime2.Artifact.import_data(dtype, destination)
+        for (name, query, dtype), destination in zip(queries, downloads):
+            results[name] = _import_silva_file(destination, dtype, tmpdirname)
+            os.remove(destination)
     return results
 
 
+def _import_silva_file(fp, dtype, tmpdir):
+    '''
+    Import a downloaded SILVA file as a QIIME 2 artifact, gunzipping it on
+    demand (SILVA releases are inconsistently gzipped).
+    '''
+    if dtype == 'FeatureData[RNASequence]':
+        # write the sequences straight into the artifact's directory format,
+        # so that they are not copied through an intermediate file first
+        view = RNASequencesDirectoryFormat()
+        output_fp = os.path.join(str(view), 'rna-sequences.fasta')
+    else:
+        view = output_fp = os.path.join(
+            tmpdir, os.path.splitext(os.path.basename(fp))[0])
+    if _is_gzipped(fp):
+        _gzip_decompress(fp, output_fp)
+    elif isinstance(view, str):
+        view = fp
+    else:
+        shutil.copyfile(fp, output_fp)
+    return qiime2.Artifact.import_data(dtype, view)
+
+
+def _mirror_url(url, mirror=None):
+    '''Point a SILVA URL at a mirror (local directory or URL).'''
+    if mirror is None:
+        return url
+    if '://' not in mirror:
+        mirror = pathlib.Path(mirror).resolve().as_uri()
+    return mirror.rstrip('/') + '/' + url[len(_SILVA_BASE_URL):]
+
+
+def _download_silva_file(query, download_dir, mirror=None):
+    '''
+    Download a SILVA file and validate its md5 checksum.
+
+    Return str
+        Path to the downloaded file.
+    '''
+    url = _mirror_url(query, mirror)
+    print('retrieving {0} from: {1}'.format(os.path.basename(query), url))
+    destination = os.path.join(download_dir, os.path.basename(query))
+    file_md5 = _download_file(url, destination)
+    # grab expected md5
+    # NOTE: SILVA is missing md5s for some files, so we will just skip
+    md5_destination = destination + '.md5'
+    try:
+        exp_md5 = _fetch_silva_md5(url + '.md5', md5_destination)
+        if exp_md5 is None:
+            msg = ("No md5 file was detected in the SILVA archive for the "
+                   "following file. No action is required, but be aware "
+                   "that md5-hash validation was not performed for this "
+                   "file: " + query)
+            warnings.warn(msg, UserWarning)
+        else:
+            # validate md5 checksum
+            _validate_md5(exp_md5, file_md5, query)
+    # do not resume from a corrupt download
+    except ValueError:
+        os.remove(destination)
+        raise
+    finally:
+        if os.path.exists(md5_destination):
+            os.remove(md5_destination)
+    return destination
+
+
+def _fetch_silva_md5(url, destination):
+    '''
+    Download and read a SILVA md5 file.
+
+    Only a missing md5 file (HTTP 404, or a missing file in a local mirror)
+    returns None; any other error (e.g., a dropped connection) is raised, so
+    that md5-hash validation is never silently skipped.
+    '''
+    try:
+        urlretrieve(url, destination)
+    except HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+    except URLError as e:
+        if isinstance(e.reason, FileNotFoundError):
+            return None
+        raise
+    return _read_silva_md5(destination)
+
+
+def _download_file(url, destination, chunksize=_DOWNLOAD_CHUNK_SIZE):
+    '''
+    Download a file, resuming a partial download of it if one exists.
+
+    Data are streamed to "destination.part", which is renamed to destination
+    once complete. The md5 checksum is computed while streaming. The ETag (or
+    Last-Modified date) of the file is stored in "destination.part.validator"
+    and sent as If-Range when resuming, so that a file that has changed on the
+    server is downloaded from scratch instead of being spliced onto the old
+    partial download.
+
+    Return str
+        md5 hex digest of the downloaded file.
+    '''
+    partial = destination + '.part'
+    validator_fp = partial + '.validator'
+    validator = _read_validator(validator_fp)
+    # partial downloads that cannot be validated are not resumed
+    if validator is not None and os.path.exists(partial):
+        offset = os.path.getsize(partial)
+    else:
+        offset = 0
+    md5_hash = hashlib.md5()
+    headers = {}
+    if offset:
+        with open(partial, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunksize), b""):
+                md5_hash.update(chunk)
+        headers['Range'] = 'bytes={0}-'.format(offset)
+        headers['If-Range'] = validator
+    try:
+        response = urlopen(Request(url, headers=headers))
+    except HTTPError as e:
+        # the partial download is complete, or the file has changed
+        if e.code == 416 and offset:
+            _remove_partial_download(partial)
+            return _download_file(url, destination, chunksize)
+        raise
+    with response:
+        resumed = bool(offset) and response.getcode() == 206
+        changed = _get_validator(response) not in (None, validator)
+        # the server sent part of a different version of the file
+        if resumed and changed:
+            stale = True
+        else:
+            stale = False
+            # start over if the server (or a file:// URL) ignores the range,
+            # or the file has changed since the partial download
+            if not resumed:
+                md5_hash = hashlib.md5()
+                _write_validator(validator_fp, _get_validator(response))
+            with open(partial, 'ab' if resumed else 'wb') as out:
+                for chunk in iter(lambda: response.read(chunksize), b""):
+                    out.write(chunk)
+                    md5_hash.update(chunk)
+    if stale:
+        _remove_partial_download(partial)
+        return _download_file(url, destination, chunksize)
+    os.replace(partial, destination)
+    _remove_partial_download(partial)
+    return md5_hash.hexdigest()
+
+
+def _get_validator(response):
+    '''
+    Return the strong ETag of a response, or its Last-Modified date if it has
+    none (weak ETags cannot be used with If-Range).
+    '''
+    etag = response.headers.get('ETag')
+    if etag is not None and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('Last-Modified')
+
+
+def _read_validator(fp):
+    if not os.path.exists(fp):
+        return None
+    with open(fp, 'r') as fh:
+        return fh.read() or None
+
+
+def _write_validator(fp, validator):
+    if validator is None:
+        if os.path.exists(fp):
+            os.remove(fp)
+    else:
+        with open(fp, 'w') as out:
+            out.write(validator)
+
+
+def _remove_partial_download(partial):
+    for fp in (partial, partial + '.validator'):
+        if os.path.exists(fp):
+            os.remove(fp)
+
+
 def _validate_md5(exp_md5, file_md5, filename):
     if not exp_md5 == file_md5:
         raise ValueError('md5 sums do not match. Manually verify md5 sums '
@@ -144,15 +321,13 @@ def _read_silva_md5(file):
     return _md5
 
 
-def _get_md5(file, chunksize=8192):
-    md5_hash = hashlib.md5()
-    with open(file, "rb") as f:
-        for chunk in iter(lambda: f.read(chunksize), b""):
-            md5_hash.update(chunk)
-    return md5_hash.hexdigest()
+def _is_gzipped(fp):
+    with open(fp, 'rb') as fh:
+        return fh.read(2) == b'\x1f\x8b'
 
 
-def _gzip_decompress(input_fp, output_fp):
-    with gzip.open(input_fp, 'rt') as temp_in:
-        with open(output_fp, 'w') as temp_out:
-            shutil.copyfileobj(temp_in, temp_out)
+def _gzip_decompress(input_fp, output_fp, chunksize=_DOWNLOAD_CHUNK_SIZE):
+    # decompress in binary mode, skipping pointless text decoding/encoding
+    with gzip.open(input_fp, 'rb') as temp_in:
+        with open(output_fp, 'wb') as temp_out:
+            shutil.copyfileobj(temp_in, temp_out, chunksize)
@@ -9,8 +9,7 @@
 
 import pandas as pd
 from ._utilities import (_rank_length, _taxon_to_list, _find_top_score,
-                         _rank_handles, _find_lca, _find_super_lca,
-                         _find_lca_majority)
+                         _rank_handles, _find_consensus_batch)
 
 
 MODE_ERROR_SCORE = (
@@ -29,18 +28,12 @@ def merge_taxa(data: pd.DataFrame,
             lambda x: _taxon_to_list(x, rank_handle=rank_handle_regex))
 
     # consensus and other dataset-specific data are meaningless after LCA
-    # or majority so we will just drop them and apply functions across rows.
+    # or majority so we will just drop them and find the consensus of each
+    # feature across all inputs at once.
     if mode in ['lca', 'super', 'majority']:
-        data = [d[['Taxon']] for d in data]
-        data = pd.concat(data, axis=1, sort=True).fillna('')
-        if mode == 'lca':
-            func = _find_lca
-        elif mode == 'super':
-            func = _find_super_lca
-        elif mode == 'majority':
-            func = _find_lca_majority
-        result = data.apply(lambda x: func([t for t in x if t != '']), axis=1)
-        result = result.to_frame(name='Taxon')
+        data = pd.concat([d['Taxon'] for d in data])
+        result = _find_consensus_batch(data.tolist(), data.index, mode=mode)
+        result = result.sort_index().to_frame(name='Taxon')
 
     # len and score modes are computed pairwise to preserve other taxon info
     else:
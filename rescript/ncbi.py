@@ -6,17 +6,63 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import io
+import os
+import json
 import time
+import sqlite3
+import hashlib
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from xml.etree import ElementTree
 
 import requests
+from requests.adapters import HTTPAdapter
 from xmltodict import parse
+from xml.parsers.expat import ExpatError
 from pandas import DataFrame
-from q2_types.feature_data import DNAIterator
-from skbio import DNA
+from q2_types.feature_data import DNAFASTAFormat
 from qiime2 import Metadata
 from collections import OrderedDict
 
+from ._utilities import _get_cache_dir, _batched
+
+_ENTREZ_BASE_URL = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/'
+
+# NCBI allows 3 requests per second, or 10 with an API key
+_ENTREZ_API_KEY_ENV = 'NCBI_API_KEY'
+_ENTREZ_RATE = 3
+_ENTREZ_RATE_WITH_API_KEY = 10
+
+# number of records fetched per efetch request, and the maximum number of
+# efetch requests in flight at a time
+_EFETCH_RETMAX = 500
+_EFETCH_THREADS = 4
+
+# (connect, read) timeouts in seconds, and the retry policy for requests
+# that fail with a connection error or a transient HTTP error: retries wait
+# _ENTREZ_BACKOFF seconds, doubling after each attempt, unless the server
+# says otherwise with a Retry-After header
+_ENTREZ_TIMEOUT = (10, 120)
+_ENTREZ_RETRIES = 5
+_ENTREZ_BACKOFF = 1.
+_ENTREZ_RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# all Entrez requests share a pool of keep-alive connections
+_session = None
+_session_lock = threading.Lock()
+
+# downloaded efetch pages are checkpointed in the RESCRIPt cache, so that
+# failed downloads resume where they left off
+_CHECKPOINT_DB = 'checkpoints.sqlite'
+
+# taxonomy records are cached by taxid, and fetched again once they are older
+# than _TAXONOMY_CACHE_TTL seconds
+_TAXONOMY_CACHE_DB = 'taxonomy.sqlite'
+_TAXONOMY_CACHE_TTL = 30 * 24 * 60 * 60
+
 _default_ranks = [
     'kingdom', 'phylum', 'class', 'order', 'family', 'genus', 'species'
 ]
@@ -58,144 +104,434 @@ _allowed_ranks = OrderedDict([
 def get_ncbi_data(
         query: str = None, accession_ids: Metadata = None,
         ranks: list = None, rank_propagation: bool = True,
-        entrez_delay: float = 0.334) -> (DNAIterator, DataFrame):
+        entrez_delay: float = None) -> (DNAFASTAFormat, DataFrame):
     if query is None and accession_ids is None:
         raise ValueError('Query or accession_ids must be supplied')
     if ranks is None:
         ranks = _default_ranks
 
-    if query:
-        seqs, taxids = get_nuc_for_query(query, entrez_delay)
+    # sequences are streamed to disk, only accession -> taxid is kept
+    seqs = DNAFASTAFormat()
+    taxids = {}
+    with open(str(seqs), 'w') as fasta:
+        if query:
+            _write_sequences(
+                get_nuc_for_query(query, entrez_delay), fasta, taxids)
 
-    if accession_ids:
-        accs = accession_ids.get_ids()
-        if query and seqs:
-            accs = accs - seqs.keys()
+        if accession_ids:
+            accs = accession_ids.get_ids()
+            if query and taxids:
+                accs = accs - taxids.keys()
             if accs:
-                acc_seqs, acc_taxids = get_nuc_for_accs(accs, entrez_delay)
-                seqs.update(acc_seqs)
-                taxids.update(acc_taxids)
-        else:
-            seqs, taxids = get_nuc_for_accs(accs, entrez_delay)
+                _write_sequences(
+                    get_nuc_for_accs(accs, entrez_delay), fasta, taxids)
 
     taxa = get_taxonomies(
         taxids, ranks, rank_propagation, entrez_delay)
 
-    seqs = DNAIterator(DNA(v, metadata={'id': k}) for k, v in seqs.items())
     taxa = DataFrame(taxa, index=['Taxon']).T
     taxa.index.name = 'Feature ID'
 
     return seqs, taxa
 
 
-def _get(params, ids=None, entrez_delay=0.):
+def _write_sequences(records, fasta, taxids):
+    '''
+    Write (accession, taxid, sequence) records to an open FASTA file, and
+    record their taxids in taxids. Accessions already in taxids are skipped.
+    '''
+    for acc, taxid, seq in records:
+        if acc not in taxids:
+            fasta.write('>' + acc + '\n' + seq + '\n')
+            taxids[acc] = taxid
+
+
+class _TokenBucket:
+    '''
+    Thread-safe token bucket, limiting the rate of requests.
+
+    rate: float
+        Number of tokens added per second.
+    capacity: int
+        Maximum number of tokens, i.e., the largest burst of requests.
+    '''
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''Wait until a token is available, and take it.'''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            # tokens are reserved immediately, so that concurrent callers
+            # queue up behind each other instead of racing for the next one
+            self._tokens -= 1
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+def _get_rate_limiter(entrez_delay=None):
+    # by default, go as fast as the Entrez guidelines allow; a delay can only
+    # slow requests down further
+    if os.environ.get(_ENTREZ_API_KEY_ENV):
+        rate = _ENTREZ_RATE_WITH_API_KEY
+    else:
+        rate = _ENTREZ_RATE
+    if entrez_delay:
+        rate = min(rate, 1. / entrez_delay)
+    return _TokenBucket(rate)
+
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=_EFETCH_THREADS + 1)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def _retry_delay(response, attempt):
+    retry_after = None
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after)
+    return _ENTREZ_BACKOFF * 2 ** attempt
+
+
+def _entrez_request(eutil, limiter, params=None, data=None):
+    '''
+    Send a rate-limited request to an Entrez E-utility. Requests are POSTed
+    if data are given, and sent as GET requests otherwise. Connection errors
+    and transient HTTP errors (429/5xx) are retried with exponential backoff.
+    '''
+    api_key = os.environ.get(_ENTREZ_API_KEY_ENV)
+    if api_key and data is not None:
+        data = dict(data, api_key=api_key)
+    elif api_key:
+        params = dict(params, api_key=api_key)
+    url = _ENTREZ_BASE_URL + eutil + '.fcgi'
+    method = 'POST' if data is not None else 'GET'
+    session = _get_session()
+    for attempt in range(_ENTREZ_RETRIES + 1):
+        limiter.acquire()
+        r = None
+        try:
+            r = session.request(method, url, params=params, data=data,
+                                timeout=_ENTREZ_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == _ENTREZ_RETRIES:
+                raise
+        else:
+            if (r.status_code not in _ENTREZ_RETRY_STATUS or
+                    attempt == _ENTREZ_RETRIES):
+                return r
+        time.sleep(_retry_delay(r, attempt))
+
+
+def _element_to_dict(elem):
+    record = {}
+    for child in elem:
+        if not len(child):
+            record[child.tag] = child.text
+        # lists of records, e.g., the LineageEx of a taxonomy record
+        elif any(len(grandchild) for grandchild in child):
+            record[child.tag] = [_element_to_dict(c) for c in child]
+        else:
+            record[child.tag] = _element_to_dict(child)
+    return record
+
+
+def _parse_records(source):
+    '''
+    Incrementally parse an efetch XML response, yielding each record (e.g.,
+    TSeq or Taxon elements) as a dict as soon as it has been read, and
+    discarding it from the parse tree.
+    '''
+    depth = 0
+    for event, elem in ElementTree.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if depth == 0:
+                root = elem
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1:
+                yield _element_to_dict(elem)
+                root.clear()
+
+
+def _efetch(params, retstart, limiter):
+    '''
+    Fetch one page of records. Any failure is raised as a RuntimeError, so
+    that _get can stop the download and report it.
+    '''
+    params = dict(params, retstart=retstart, retmax=_EFETCH_RETMAX)
+    try:
+        r = _entrez_request('efetch', limiter, params=params)
+    except requests.RequestException as e:
+        raise RuntimeError('Request failed: {0}'.format(e))
+    if r.status_code != requests.codes.ok:
+        raise RuntimeError(_efetch_error(r))
+    try:
+        return list(_parse_records(io.BytesIO(r.content)))
+    except ElementTree.ParseError as e:
+        raise RuntimeError('Could not parse the efetch response: '
+                           '{0}'.format(e))
+
+
+def _efetch_error(response):
+    # error pages are not always Entrez XML, e.g., 502 errors from a proxy
+    try:
+        error = list(parse(response.content).values()).pop()['ERROR']
+    except (ExpatError, TypeError, KeyError, IndexError):
+        error = response.text
+    return 'HTTP {0}: {1}'.format(response.status_code, error)
+
+
+def _download_error(expected_num_records, num_records, missing_ids=None,
+                    error=None):
+    error_msg = 'Download did not finish.\n'
+    if num_records < expected_num_records:
+        error_msg += ('\n' + str(expected_num_records) + ' records were '
+                      'expected but only ' + str(num_records) +
+                      ' were received.\n')
+        if missing_ids:
+            if len(missing_ids) > 10:
+                error_msg += '\nThe first 10 missing records were '
+            else:
+                error_msg += '\nThe missing records were '
+            error_msg += ', '.join(missing_ids[:10]) + '.\n'
+    if error is not None:
+        error_msg += '\nThe following error was received:\n' + error
+    return error_msg
+
+
+def _checkpoint_db():
+    db = sqlite3.connect(
+        os.path.join(_get_cache_dir('ncbi'), _CHECKPOINT_DB), timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS pages (key TEXT, retstart INTEGER,'
+               ' num_records INTEGER, records TEXT,'
+               ' PRIMARY KEY (key, retstart))')
+    return db
+
+
+def _checkpoint_key(*args):
+    return hashlib.md5(json.dumps(args, sort_keys=True).encode()).hexdigest()
+
+
+def _checkpoint_pages(key):
+    '''Return the number of checkpointed records in each page, by retstart.'''
+    with closing(_checkpoint_db()) as db:
+        return dict(db.execute(
+            'SELECT retstart, num_records FROM pages WHERE key = ?', (key,)))
+
+
+def _iter_checkpoint(key):
+    '''Stream the checkpointed records, in retstart order.'''
+    with closing(_checkpoint_db()) as db:
+        for records, in db.execute('SELECT records FROM pages WHERE key = ? '
+                                   'ORDER BY retstart', (key,)):
+            yield from json.loads(records)
+
+
+def _save_checkpoint(key, retstart, records):
+    with closing(_checkpoint_db()) as db, db:
+        db.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?)',
+                   (key, retstart, len(records), json.dumps(records)))
+
+
+def _clear_checkpoint(key):
+    with closing(_checkpoint_db()) as db:
+        with db:
+            db.execute('DELETE FROM pages WHERE key = ?', (key,))
+        # give the space of the deleted pages back to the file system
+        db.execute('VACUUM')
+
+
+def _record_ids(record):
+    '''Return the IDs that a sequence or taxonomy record can be posted by.'''
+    ids = set()
+    if 'TSeq_accver' in record:
+        ids.update([record['TSeq_accver'],
+                    record['TSeq_accver'].split('.')[0]])
+    for field in ['TSeq_gi', 'TaxId']:
+        if field in record:
+            ids.add(record[field])
+    return ids
+
+
+def _checkpoint_ids(key):
+    ids = set()
+    for record in _iter_checkpoint(key):
+        ids.update(_record_ids(record))
+    return ids
+
+
+def _fetch_page(params, retstart, limiter, key, checkpoint_retstart):
+    records = _efetch(params, retstart, limiter)
+    _save_checkpoint(key, checkpoint_retstart, records)
+    return len(records)
+
+
+def _get(params, ids=None, entrez_delay=None):
+    '''
+    Download records from Entrez, for a list of ids or for an esearch query.
+
+    Downloaded pages of records are checkpointed on disk, so that a failed
+    download resumes on the next run: for a query, by skipping the pages that
+    were already downloaded, and for a list of ids, by only fetching the ids
+    that are not in the checkpoint yet. Once all pages have been downloaded,
+    records are streamed from the checkpoint as dicts, and the checkpoint is
+    cleared.
+    '''
+    limiter = _get_rate_limiter(entrez_delay)
     if ids:
         assert len(ids) >= 1, "need at least one id"
-        epost = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/epost.fcgi'
-        data = {'db': params['db'], 'id': ','.join(ids)}
-        time.sleep(entrez_delay)
-        r = requests.post(epost, data=data)
-        r.raise_for_status()
-        webenv = parse(r.content)['ePostResult']
-        if 'ERROR' in webenv:
-            if isinstance(webenv['ERROR'], list):
-                for error in webenv['ERROR']:
-                    warnings.warn(error, UserWarning)
-            else:
-                warnings.warn(webenv['ERROR'], UserWarning)
-        if 'WebEnv' not in webenv:
-            raise ValueError('No data for given ids')
-        params['WebEnv'] = webenv['WebEnv']
-        params['query_key'] = webenv['QueryKey']
+        key = _checkpoint_key('ids', params['db'], sorted(ids))
+        pages = _checkpoint_pages(key)
+        # checkpoint newly fetched pages after the ones already stored, which
+        # are not necessarily contiguous if an earlier page failed
+        offset = max((retstart + num_records
+                      for retstart, num_records in pages.items()), default=0)
+        stored_ids = _checkpoint_ids(key) if pages else set()
+        remaining_ids = [_id for _id in ids if _id not in stored_ids]
+        if remaining_ids:
+            data = {'db': params['db'], 'id': ','.join(remaining_ids)}
+            r = _entrez_request('epost', limiter, data=data)
+            r.raise_for_status()
+            webenv = parse(r.content)['ePostResult']
+            if 'ERROR' in webenv:
+                if isinstance(webenv['ERROR'], list):
+                    for error in webenv['ERROR']:
+                        warnings.warn(error, UserWarning)
+                else:
+                    warnings.warn(webenv['ERROR'], UserWarning)
+            if 'WebEnv' not in webenv:
+                raise ValueError('No data for given ids')
+            params['WebEnv'] = webenv['WebEnv']
+            params['query_key'] = webenv['QueryKey']
+        retstarts = range(0, len(remaining_ids), _EFETCH_RETMAX)
         expected_num_records = len(ids)
     else:
-        esearch = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi'
-        time.sleep(entrez_delay)
-        r = requests.get(esearch, params=params)
+        r = _entrez_request('esearch', limiter, params=params)
         r.raise_for_status()
         webenv = parse(r.content)['eSearchResult']
         if 'WebEnv' not in webenv:
             raise ValueError('No sequences for given query')
+        expected_num_records = int(webenv['Count'])
+        key = _checkpoint_key('query', params, expected_num_records)
+        pages = _checkpoint_pages(key)
+        offset = 0
         params = dict(
             db='nuccore', rettype='fasta', retmode='xml',
             WebEnv=webenv['WebEnv'], query_key=webenv['QueryKey']
         )
-        expected_num_records = int(webenv['Count'])
+        retstarts = [retstart for retstart in range(
+            0, expected_num_records, _EFETCH_RETMAX) if retstart not in pages]
 
-    efetch = 'https://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi'
-    data = []
-    while len(data) < expected_num_records:
-        params['retstart'] = len(data)
-        time.sleep(entrez_delay)
-        r = requests.get(efetch, params=params)
-        if r.status_code != requests.codes.ok:
-            content = parse(r.content)
-            content = list(content.values()).pop()
-            error = 'Download did not finish.\n'
-            if len(data) < expected_num_records:
-                error += ('\n' + str(expected_num_records) + ' records were '
-                          'expected but only ' + str(len(data)) +
-                          ' were received.\n')
-                if ids:
-                    ungotten = []
-                    for _id in ids:
-                        ungotten_id = True
-                        for datum in data:
-                            if _id in str(datum):
-                                ungotten_id = False
-                                break
-                        if ungotten_id:
-                            ungotten.append(_id)
-                    if len(ungotten) > 10:
-                        error += '\nThe first 10 missing records were '
-                    else:
-                        error += '\nThe missing records were '
-                    error += ', '.join(ungotten[:10]) + '.\n'
-            error += ('\nThe following error was '
-                      'received:\n' + content['ERROR'])
-            raise RuntimeError(error)
-        chunk = parse(r.content)
-        chunk = list(chunk.values()).pop()
-        chunk = list(chunk.values()).pop()
-        if isinstance(chunk, list):
-            data.extend(chunk)
-        else:
-            data.append(chunk)
-    return data
+    def _missing_ids():
+        if ids:
+            stored_ids = _checkpoint_ids(key)
+            return [_id for _id in ids if _id not in stored_ids]
+
+    # keep several efetch requests in flight, while the token bucket keeps
+    # the request rate inside the Entrez guidelines. Pages are written to
+    # the checkpoint as they arrive, so only the pages in flight are held in
+    # memory.
+    with ThreadPoolExecutor(max_workers=_EFETCH_THREADS) as executor:
+        futures = [(offset + retstart, executor.submit(
+                        _fetch_page, params, retstart, limiter, key,
+                        offset + retstart))
+                   for retstart in retstarts]
+        try:
+            for retstart, future in futures:
+                pages[retstart] = future.result()
+        except RuntimeError as e:
+            for _, future in futures:
+                future.cancel()
+            raise RuntimeError(_download_error(
+                expected_num_records, sum(pages.values()), _missing_ids(),
+                str(e)))
+    if sum(pages.values()) < expected_num_records:
+        raise RuntimeError(_download_error(
+            expected_num_records, sum(pages.values()), _missing_ids()))
+    yield from _iter_checkpoint(key)
+    _clear_checkpoint(key)
 
 
-def get_nuc_for_accs(accs, entrez_delay=0.):
+def get_nuc_for_accs(accs, entrez_delay=None):
+    '''Yield (accession, taxid, sequence) for a list of accessions.'''
     params = dict(
         db='nuccore', rettype='fasta', retmode='xml'
     )
-    records = _get(params, accs, entrez_delay)
-    seqs = {}
-    taxids = {}
-    for rec in records:
-        seqs[rec['TSeq_accver']] = rec['TSeq_sequence']
-        taxids[rec['TSeq_accver']] = rec['TSeq_taxid']
-    return seqs, taxids
+    for rec in _get(params, accs, entrez_delay):
+        yield rec['TSeq_accver'], rec['TSeq_taxid'], rec['TSeq_sequence']
 
 
-def get_nuc_for_query(query, entrez_delay=0.):
+def get_nuc_for_query(query, entrez_delay=None):
+    '''Yield (accession, taxid, sequence) for a query.'''
     params = dict(
         db='nuccore', term=query, usehistory='y', retmax=0
     )
-    records = _get(params, entrez_delay=entrez_delay)
-    seqs = {}
-    taxids = {}
-    for rec in records:
-        seqs[rec['TSeq_accver']] = rec['TSeq_sequence']
-        taxids[rec['TSeq_accver']] = rec['TSeq_taxid']
-    return seqs, taxids
+    for rec in _get(params, entrez_delay=entrez_delay):
+        yield rec['TSeq_accver'], rec['TSeq_taxid'], rec['TSeq_sequence']
+
+
+def _taxonomy_cache_db():
+    db = sqlite3.connect(os.path.join(
+        _get_cache_dir('ncbi'), _TAXONOMY_CACHE_DB), timeout=60)
+    db.execute('CREATE TABLE IF NOT EXISTS taxa (taxid TEXT PRIMARY KEY, '
+               'record TEXT, fetched REAL)')
+    return db
+
+
+def _load_cached_taxa(taxids):
+    '''Return the cached taxonomy records for taxids.'''
+    records = []
+    with closing(_taxonomy_cache_db()) as db, db:
+        # evict expired records
+        db.execute('DELETE FROM taxa WHERE fetched < ?',
+                   (time.time() - _TAXONOMY_CACHE_TTL,))
+        # stay below the SQLite limit on the number of query parameters
+        for batch in _batched(taxids, 500):
+            rows = db.execute(
+                'SELECT record FROM taxa WHERE taxid IN ({0})'.format(
+                    ', '.join('?' * len(batch))), batch)
+            records.extend(json.loads(record) for record, in rows)
+    return records
+
+
+def _save_cached_taxa(records):
+    fetched = time.time()
+    with closing(_taxonomy_cache_db()) as db, db:
+        db.executemany('INSERT OR REPLACE INTO taxa VALUES (?, ?, ?)',
+                       ((rec['TaxId'], json.dumps(rec), fetched)
+                        for rec in records))
 
 
 def get_taxonomies(
-        taxids, ranks=None, rank_propagation=False, entrez_delay=0.):
-    # download the taxonomies
+        taxids, ranks=None, rank_propagation=False, entrez_delay=None):
+    # download the taxonomies, once per taxid and only if they are not cached
     params = dict(db='taxonomy')
-    ids = list(map(str, taxids.values()))
-    records = _get(params, ids, entrez_delay)
+    ids = sorted(set(map(str, taxids.values())))
+    records = _load_cached_taxa(ids)
+    cached_ids = {rec['TaxId'] for rec in records}
+    ids = [_id for _id in ids if _id not in cached_ids]
+    if ids:
+        fetched_records = list(_get(params, ids, entrez_delay))
+        _save_cached_taxa(fetched_records)
+        records.extend(fetched_records)
     taxa = {}
 
     # parse the taxonomies
@@ -203,7 +539,7 @@ def get_taxonomies(
         if rank_propagation:
             taxonomy = OrderedDict([('NCBI_Division', rec['Division'])])
             taxonomy.update((r, None) for r in _allowed_ranks)
-            for rank in rec['LineageEx']['Taxon']:
+            for rank in rec.get('LineageEx') or []:
                 if rank['Rank'] in _allowed_ranks:
                     taxonomy[rank['Rank']] = rank['ScientificName']
             species = rec['ScientificName']
@@ -225,7 +561,7 @@ def get_taxonomies(
                 taxonomy['domain'] = rec['Division']
             elif 'kingdom' in ranks:
                 taxonomy['kingdom'] = rec['Division']
-            for rank in rec['LineageEx']['Taxon']:
+            for rank in rec.get('LineageEx') or []:
                 taxonomy[rank['Rank']] = rank['ScientificName']
             species = rec['ScientificName']
             # if we care about genus and genus is in the species label and
@@ -243,7 +579,7 @@ def get_taxonomies(
 
     # return the taxonomies
     missing_accs = []
-    missing_taxids = {}
+    missing_taxids = set()
     tax_strings = {}
     for acc, taxid in taxids.items():
         if taxid in taxa:
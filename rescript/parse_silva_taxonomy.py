@@ -7,9 +7,17 @@
 # ----------------------------------------------------------------------------
 
 import re
+import json
+import hashlib
+import numpy as np
 import pandas as pd
 from skbio.tree import TreeNode
 from collections import OrderedDict
+from q2_types.tree import NewickFormat
+
+import rescript
+from .types._format import SILVATaxonomyFormat, SILVATaxidMapFormat
+from ._utilities import _get_md5, _load_cached_series, _save_cached_series
 
 
 WHITESPACE_REGEX = re.compile(r'\s+')
@@ -17,6 +25,8 @@ ALLOWED_CHARS = set(''.join(['0123456789',
                              'abcdefghijklmnopqrstuvwxyz',
                              'ABCDEFGHIJKLMNOPQRSTUVWXYZ',
                              '_-[]()/.\\']))
+DISALLOWED_CHARS_REGEX = re.compile(
+    '[^{0}]'.format(re.escape(''.join(sorted(ALLOWED_CHARS)))))
 
 # Do not use "'major_clade': 'mc__'" as this appears at multiple levels, even
 #      within the same lineage. Tough to disambiguate.
@@ -39,9 +49,13 @@ SELECTED_RANKS = OrderedDict({'domain': 'd__', 'phylum': 'p__',
 def _keep_allowed_chars(lin_name, allowed_chars=ALLOWED_CHARS,
                         whitespace_pattern=WHITESPACE_REGEX):
     # Only keep "safe" characters and replace whitespace with '_'
+    if allowed_chars is ALLOWED_CHARS:
+        disallowed_pattern = DISALLOWED_CHARS_REGEX
+    else:
+        disallowed_pattern = re.compile(
+            '[^{0}]'.format(re.escape(''.join(sorted(allowed_chars)))))
     new_lin_name = whitespace_pattern.sub("_", lin_name.strip())
-    new_lin_name = ''.join(i for i in new_lin_name if i in allowed_chars)
-    return new_lin_name
+    return disallowed_pattern.sub('', new_lin_name)
 
 
 def _build_base_silva_taxonomy(tree, taxrank, allowed_ranks):
@@ -54,27 +68,25 @@ def _build_base_silva_taxonomy(tree, taxrank, allowed_ranks):
     # capture and parse
     # output : pandas DataFrame with 'taxid' as the index and the full taxonomy
     # path (i.e. domain-to-genus) as the values.
-    tid = {}
-    for node in tree.postorder():
-        if node.is_root():
-            break
-        rank_list = []
-        # the _validate_taxrank_taxtree func should run
-        # before getting here, so all looks up should pass
-        rank, taxonomy = taxrank.loc[str(node.name), ['taxrank',
-                                                      'taxid_taxonomy']]
-        # only pull taxonomy from allowed ranks
-        if rank in allowed_ranks:
-            rank_list.append((allowed_ranks[rank], taxonomy))
-        for ancestor in node.ancestors():
-            if ancestor.is_root():
-                break
-            else:
-                arank, ataxonomy = taxrank.loc[str(ancestor.name),
-                                               ['taxrank', 'taxid_taxonomy']]
-                if arank in allowed_ranks:
-                    rank_list.append((allowed_ranks[arank], ataxonomy))
-        tid[node.name.strip()] = dict(rank_list)
+    # the _validate_taxrank_taxtree func should run
+    # before getting here, so all looks up should pass
+    ranks = {taxid: (allowed_ranks.get(rank), taxonomy) for
+             taxid, rank, taxonomy in zip(taxrank.index, taxrank['taxrank'],
+                                          taxrank['taxid_taxonomy'])}
+    # traverse top-down, so that each node extends its parent's lineage.
+    # Only pull taxonomy from allowed ranks; if a rank occurs more than once
+    # in a lineage, the upper-level taxonomy is kept.
+    lineages = {id(tree): {}}
+    for node in tree.preorder(include_self=False):
+        lineage = lineages[id(node.parent)]
+        rank, taxonomy = ranks[str(node.name)]
+        if rank is not None and rank not in lineage:
+            lineage = lineage.copy()
+            lineage[rank] = taxonomy
+        lineages[id(node)] = lineage
+    # output rows in postorder
+    tid = {node.name.strip(): lineages[id(node)] for node in
+           tree.postorder(include_self=False)}
     silva_tax_id_df = pd.DataFrame.from_dict(tid, orient='index',
                                              columns=allowed_ranks.values())
     silva_tax_id_df.index.name = 'taxid'
@@ -94,9 +106,12 @@ def _prep_taxmap(taxmap):
     # This is how the coreesponding FASTA file IDs are structured
     taxmap.index = taxmap.index + '.' + taxmap.start + '.' + taxmap.stop
     taxmap.index.name = 'Feature ID'
-    taxmap = taxmap[['organism_name', 'taxid']]
-    taxmap.loc[:, 'organism_name'] = taxmap['organism_name'].apply(
-                                            _get_clean_organism_name)
+    taxmap = taxmap[['organism_name', 'taxid']].copy()
+    # clean each unique organism name once, then map back to all accessions
+    codes, names = pd.factorize(taxmap['organism_name'])
+    names = np.array([_get_clean_organism_name(n) for n in names],
+                     dtype=object)
+    taxmap['organism_name'] = names[codes]
     return taxmap
 
 
@@ -156,22 +171,61 @@ def _compile_taxonomy_output(updated_taxmap, include_species_labels=False,
     # may provide the option to allow users to feed in their own dictionary
     # of selected_ranks. The user can opt to return the species labels.
     sr = list(selected_ranks.values())
+    # the selected ranks only depend on the taxid, so assemble the taxonomy
+    # string once per unique taxid, then map back to all accessions
+    codes, taxids = pd.factorize(updated_taxmap['taxid'])
+    first_rows = updated_taxmap.iloc[pd.Series(codes).drop_duplicates().index]
     # add rank prefixes (i.e. 'p__')
-    updated_taxmap.loc[:, sr] = updated_taxmap.loc[:, sr].apply(
-                                                    lambda x: x.name + x)
+    lineages = sr[0] + first_rows[sr[0]]
+    for rank in sr[1:]:
+        lineages = lineages + '; ' + rank + first_rows[rank]
+    taxonomy = pd.Series(lineages.values[codes], index=updated_taxmap.index,
+                         dtype=object)
     if include_species_labels:
-        updated_taxmap.loc[:, 'organism_name'] = updated_taxmap.loc[
-                           :, 'organism_name'].apply(lambda x: 's__' + x)
-        sr.append('organism_name')
-    taxonomy = updated_taxmap.loc[:, sr].agg('; '.join, axis=1)
+        taxonomy = taxonomy + '; s__' + updated_taxmap['organism_name']
     taxonomy.rename('Taxon', inplace=True)
     return taxonomy
 
 
-def parse_silva_taxonomy(taxonomy_tree: TreeNode,
-                         taxonomy_map: pd.DataFrame,
-                         taxonomy_ranks: pd.DataFrame,
+def parse_silva_taxonomy(taxonomy_tree: NewickFormat,
+                         taxonomy_map: SILVATaxidMapFormat,
+                         taxonomy_ranks: SILVATaxonomyFormat,
                          include_species_labels: bool = False) -> pd.Series:
+    # SILVA releases are immutable, so a taxonomy parsed from the same files
+    # with the same options is reused from the RESCRIPt cache
+    cache_key = _silva_cache_key(taxonomy_tree, taxonomy_map, taxonomy_ranks,
+                                 include_species_labels)
+    taxonomy = _load_cached_series('silva-taxonomy', cache_key)
+    if taxonomy is not None:
+        print('Using previously parsed taxonomy from the RESCRIPt cache.')
+        taxonomy.index.name = 'Feature ID'
+        taxonomy.name = 'Taxon'
+        return taxonomy
+    taxonomy = _parse_silva_taxonomy(
+        taxonomy_tree.view(TreeNode), taxonomy_map.view(pd.DataFrame),
+        taxonomy_ranks.view(pd.DataFrame), include_species_labels)
+    _save_cached_series('silva-taxonomy', cache_key, taxonomy)
+    return taxonomy
+
+
+def _silva_cache_key(taxonomy_tree, taxonomy_map, taxonomy_ranks,
+                     include_species_labels, selected_ranks=SELECTED_RANKS):
+    '''
+    Generate the cache key of a parsed SILVA taxonomy.
+
+    The key combines the md5s of the taxonomy files with the parsing options
+    and the RESCRIPt version, so that cached taxonomies are never reused by a
+    version that may parse them differently.
+    '''
+    md5s = [_get_md5(str(fmt))
+            for fmt in (taxonomy_tree, taxonomy_map, taxonomy_ranks)]
+    key = [rescript.__version__, md5s, include_species_labels,
+           list(selected_ranks.values())]
+    return hashlib.md5(json.dumps(key).encode()).hexdigest()
+
+
+def _parse_silva_taxonomy(taxonomy_tree, taxonomy_map, taxonomy_ranks,
+                          include_species_labels=False):
     # Traverse the taxonomy hierarchy tree (taxonomy_tree) to obtain the
     # taxids. These will be used to look up the taxonomy and rank information
     # from the taxonomy_ranks file. Finally the taxonomy information is
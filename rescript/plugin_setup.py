@@ -14,7 +14,7 @@ from .merge import merge_taxa
 from .dereplicate import dereplicate
 from .evaluate import evaluate_taxonomy, evaluate_seqs
 from .screenseq import cull_seqs
-from .degap import degap_seqs
+from .degap import degap_seqs, trim_alignment_columns
 from .parse_silva_taxonomy import parse_silva_taxonomy
 from .get_data import get_silva_data
 from .cross_validate import (evaluate_cross_validate,
@@ -388,7 +388,9 @@ plugin.methods.register_function(
         },
     parameters={
         'num_degenerates': Int % Range(1, None),
-        'homopolymer_length': Int % Range(2, None)
+        'homopolymer_length': Int % Range(2, None),
+        'engine': Str % Choices(['vectorized', 'skbio']),
+        'threads': VSEARCH_PARAMS['threads']
         },
     outputs=[('clean_sequences', FeatureData[Sequence])],
     input_descriptions={
@@ -400,6 +402,14 @@ plugin.methods.register_function(
                            'be removed.',
         'homopolymer_length': 'Sequences containing a homopolymer sequence of '
                               'length N, or greater, will be removed.',
+        'engine': 'Screening implementation to use. "vectorized" screens '
+                  'sequences in large batches using array operations and is '
+                  'much faster for large inputs. "skbio" screens each '
+                  'sequence individually with scikit-bio. Both engines '
+                  'produce identical results.',
+        'threads': 'Number of worker processes used to screen sequences in '
+                   'parallel (1 to 256). Sequences are screened in chunks '
+                   'and written out in their original order.',
     },
     output_descriptions={
         'clean_sequences': 'The resulting DNA sequences that pass degenerate '
@@ -445,6 +455,42 @@ plugin.methods.register_function(
 )
 
 
+plugin.methods.register_function(
+    function=trim_alignment_columns,
+    inputs={
+        'aligned_sequences': FeatureData[AlignedSequence]
+        },
+    parameters={
+        'max_gap_frequency': Float % Range(0, 1, inclusive_end=True),
+        'position_start': Int % Range(1, None),
+        'position_end': Int % Range(1, None)
+        },
+    outputs=[('trimmed_sequences', FeatureData[AlignedSequence])],
+    input_descriptions={
+        'aligned_sequences': 'Aligned DNA Sequences to be trimmed.'
+        },
+    parameter_descriptions={
+        'max_gap_frequency': 'Remove alignment columns in which the fraction '
+                             'of sequences containing a gap ("-") or missing '
+                             'data (".") character is greater than this '
+                             'value. For example, 0.9 removes columns that '
+                             'are gaps in more than 90% of sequences.',
+        'position_start': 'Remove all alignment columns before this position '
+                          '(1-based, inclusive).',
+        'position_end': 'Remove all alignment columns after this position '
+                        '(1-based, inclusive).'},
+    output_descriptions={
+        'trimmed_sequences': 'The trimmed DNA sequence alignment.'
+        },
+    name='Remove columns from a DNA sequence alignment.',
+    description=('Remove alignment columns by gap frequency and/or by '
+                 'position, e.g., prior to degapping. The alignment is '
+                 'processed in two streaming passes (one to count gaps in '
+                 'each column and one to write out the trimmed alignment), '
+                 'so the alignment is never loaded into memory.')
+)
+
+
 FILTER_PARAMS = {
     'global_min': Int % Range(1, None),
     'global_max': Int % Range(1, None)}
@@ -544,19 +590,28 @@ plugin.methods.register_function(
     inputs={'sequences': FeatureData[Sequence]},
     parameters={
         **FILTER_PARAMS,
-        'threads': VSEARCH_PARAMS['threads']},
+        'threads': VSEARCH_PARAMS['threads'],
+        'engine': Str % Choices(['vsearch', 'native']),
+        'length_summary': Bool},
     outputs=[('filtered_seqs', FeatureData[Sequence]),
              ('discarded_seqs', FeatureData[Sequence])],
     input_descriptions={
         'sequences': 'Sequences to be filtered by length.'},
     parameter_descriptions={
         **FILTER_PARAM_DESCRIPTIONS,
-        'threads': VSEARCH_PARAM_DESCRIPTIONS['threads']},
+        'threads': VSEARCH_PARAM_DESCRIPTIONS['threads'],
+        'engine': 'Filtering implementation to use. "vsearch" filters with '
+                  'VSEARCH. "native" filters within RESCRIPt, without '
+                  'launching an external process. Both engines retain the '
+                  'same sequences; "threads" only applies to "vsearch".',
+        'length_summary': 'Print the number of sequences retained, and a '
+                          'histogram of the input sequence lengths.'},
     output_descriptions=FILTER_OUTPUT_DESCRIPTIONS,
     name='Filter sequences by length.',
     description=(
-        'Filter sequences by length with VSEARCH. For a combination of global '
-        'and conditional taxonomic filtering, see filter_seqs_length_by_taxon.'
+        'Filter sequences by length with VSEARCH or natively. For a '
+        'combination of global and conditional taxonomic filtering, see '
+        'filter_seqs_length_by_taxon.'
     ),
     citations=[citations['rognes2016vsearch']]
 )
@@ -584,7 +639,8 @@ plugin.pipelines.register_function(
         'version': version_map,
         'target': target_map,
         'include_species_labels': Bool,
-        'download_sequences': Bool},
+        'download_sequences': Bool,
+        'mirror': Str},
     outputs=[('silva_sequences', FeatureData[RNASequence]),
              ('silva_taxonomy', FeatureData[Taxonomy])],
     input_descriptions={},
@@ -603,7 +659,12 @@ plugin.pipelines.register_function(
                               'already exists or for testing purposes. NOTE: '
                               'if this option is used, a `silva_sequences` '
                               'output is still created, but contains no '
-                              'data.'},
+                              'data.',
+        'mirror': 'Download the SILVA files from a mirror instead of the '
+                  'SILVA website: a local directory or a URL (e.g., '
+                  'file:///path/to/silva_databases) that mirrors the '
+                  'directory structure of '
+                  'https://www.arb-silva.de/fileadmin/silva_databases/.'},
     output_descriptions={
         'silva_sequences': 'SILVA reference sequences.',
         'silva_taxonomy': 'SILVA reference taxonomy.'},
@@ -704,8 +765,11 @@ plugin.methods.register_function(
                  "NCBI Taxonomy database. [default: '" +
                  "', '".join(_default_ranks) + "']",
         'rank_propagation': 'Propagate known ranks to missing ranks if true',
-        'entrez_delay': 'Delay between queries (in seconds) to stay inside '
-                        'the Entrez Guidelines'},
+        'entrez_delay': 'Delay between queries (in seconds). By default, '
+                        'requests are sent as fast as the Entrez guidelines '
+                        'allow: 3 requests per second, or 10 if an API key '
+                        'is set in the NCBI_API_KEY environment variable. A '
+                        'delay can only slow requests down further.'},
     output_descriptions={
         'sequences': 'Sequences from the NCBI Nucleotide database',
         'taxonomy': 'Taxonomies from the NCBI Taxonomy database'},
@@ -724,7 +788,8 @@ plugin.methods.register_function(
     parameters={
         'ids_to_keep': Metadata,
         'include': List[Str],
-        'exclude': List[Str]},
+        'exclude': List[Str],
+        'rank_handle': Str},
     outputs=[('filtered_taxonomy', FeatureData[Taxonomy])],
     input_descriptions={'taxonomy': 'Taxonomy to filter.'},
     parameter_descriptions={
@@ -736,7 +801,13 @@ plugin.methods.register_function(
         'exclude': 'List of search terms. Taxa containing one or more of '
                    'these terms will be excluded. Exclusion filtering occurs '
                    'after inclusion filtering and prior to selecting '
-                   '`ids_to_keep`.'},
+                   '`ids_to_keep`.',
+        'rank_handle': 'Only match `include` and `exclude` search terms '
+                       'against the taxonomic labels at a single rank, '
+                       'identified by the rank handle that prefixes them '
+                       '(e.g., "g__" to search genus labels only). By '
+                       'default, search terms are matched against the full '
+                       'taxonomy string.'},
     output_descriptions={
         'filtered_taxonomy': 'The filtered taxonomy.'},
     name='Filter taxonomy by list of IDs or search criteria.',
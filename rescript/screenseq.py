@@ -6,8 +6,30 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import io
 import re
-from q2_types.feature_data import DNAFASTAFormat, DNAIterator
+import numpy as np
+import skbio
+from functools import partial
+from q2_types.feature_data import DNAFASTAFormat
+
+from ._utilities import (_parallel_map, _parse_fasta_lines,
+                         _read_fasta_chunks, _write_fasta_record)
+
+# size in bytes of the FASTA chunks screened at once (i.e., per worker task)
+_SCREEN_CHUNK_SIZE = 1 << 22
+
+
+def _char_lookup_table(chars):
+    # boolean lookup table indexed by byte value
+    table = np.zeros(256, dtype=bool)
+    table[np.frombuffer(chars, dtype=np.uint8)] = True
+    return table
+
+
+_DEGENERATE_LUT = _char_lookup_table(b'RYSWKMBDHVN')
+# same character set that is matched by the regex in _filter_homopolymer
+_HOMOPOLYMER_LUT = _char_lookup_table(b'ACGTURYSWKMBDHVN')
 
 
 def _filt_seq_with_degenerates(seq, num_degenerates):
@@ -22,14 +44,78 @@ def _filter_homopolymer(seq, homopolymer_length):
     return any(homopolymers)
 
 
-def cull_seqs(sequences: DNAIterator, num_degenerates: int = 5,
-              homopolymer_length: int = 8) -> DNAFASTAFormat:
+def _screen_batch(seqs, num_degenerates, homopolymer_length):
+    '''
+    Screen a batch of sequences for degenerate bases and homopolymers.
+
+    seqs: list of bytes
+        Sequences to screen. These are concatenated into a single buffer and
+        screened all at once.
+    num_degenerates: int
+    homopolymer_length: int
+
+    Return np.ndarray of bool
+        True for each sequence that passes both screens.
+    '''
+    lengths = np.fromiter((len(s) for s in seqs), dtype=np.int64,
+                          count=len(seqs))
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    buf = np.frombuffer(b''.join(seqs), dtype=np.uint8)
+    # count degenerate bases per record from a cumulative sum over the buffer
+    degen = np.concatenate(([0], np.cumsum(_DEGENERATE_LUT[buf])))
+    passed = (degen[ends] - degen[starts]) < num_degenerates
+    # a new run begins wherever the base changes or a new record begins
+    run_start = np.ones(len(buf), dtype=bool)
+    run_start[1:] = buf[1:] != buf[:-1]
+    run_start[starts[lengths > 0]] = True
+    run_idx = np.flatnonzero(run_start)
+    run_len = np.diff(np.append(run_idx, len(buf)))
+    homopolymers = run_idx[(run_len >= homopolymer_length) &
+                           _HOMOPOLYMER_LUT[buf[run_idx]]]
+    # map each offending run back to the record that contains it
+    passed[np.searchsorted(ends, homopolymers, side='right')] = False
+    return passed
+
+
+def _cull_chunk(chunk, num_degenerates, homopolymer_length, engine):
+    '''
+    Screen one chunk of a FASTA file, read as raw bytes.
+
+    Records are parsed here, so that the parent process only has to read and
+    write raw bytes when screening in parallel.
+
+    Return bytes
+        The records that pass both screens, as FASTA.
+    '''
+    records = list(_parse_fasta_lines(chunk.splitlines()))
+    if not records:
+        return b''
+    headers, seqs = zip(*records)
+    if engine == 'skbio':
+        dna_seqs = (skbio.DNA(seq.decode()) for seq in seqs)
+        passed = [not (_filt_seq_with_degenerates(seq, num_degenerates) or
+                       _filter_homopolymer(seq, homopolymer_length))
+                  for seq in dna_seqs]
+    else:
+        passed = _screen_batch(seqs, num_degenerates, homopolymer_length)
+    out = io.BytesIO()
+    for header, seq, keep in zip(headers, seqs, passed):
+        if keep:
+            _write_fasta_record(out, header, seq)
+    return out.getvalue()
+
+
+def cull_seqs(sequences: DNAFASTAFormat, num_degenerates: int = 5,
+              homopolymer_length: int = 8,
+              engine: str = 'vectorized',
+              threads: int = 1) -> DNAFASTAFormat:
+    cull = partial(_cull_chunk, num_degenerates=num_degenerates,
+                   homopolymer_length=homopolymer_length, engine=engine)
+    chunks = _read_fasta_chunks(str(sequences), _SCREEN_CHUNK_SIZE)
     result = DNAFASTAFormat()
-    with result.open() as out_fasta:
-        for seq in sequences:
-            degen = _filt_seq_with_degenerates(seq, num_degenerates)
-            if not degen:
-                poly = _filter_homopolymer(seq, homopolymer_length)
-                if not poly:  # if we make it here, write seq to file
-                    seq.write(out_fasta)
+    with open(str(result), 'wb') as out_fasta:
+        # results come back in input order, so output order matches input
+        for kept in _parallel_map(cull, chunks, threads):
+            out_fasta.write(kept)
     return result
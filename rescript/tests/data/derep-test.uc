@@ -0,0 +1,7 @@
+S	0	100	*	*	*	*	*	A1	*
+H	0	100	100.0	+	0	0	=	A2	A1
+S	1	100	*	*	*	*	*	B1	*
+H	0	100	100.0	+	0	0	=	A3	A1
+H	1	100	100.0	+	0	0	=	B2	B1
+C	0	3	*	*	*	*	*	A1	*
+C	1	2	*	*	*	*	*	B1	*
@@ -0,0 +1,55 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+from unittest.mock import patch
+
+from qiime2.plugin.testing import TestPluginBase
+
+from rescript.cache import clear_cache, main
+
+
+class TestClearCache(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.env = patch.dict(
+            os.environ, {'RESCRIPT_CACHE_DIR': self.cache_dir})
+        self.env.start()
+        for namespace in ['ncbi', 'silva-taxonomy']:
+            os.makedirs(os.path.join(self.cache_dir, namespace))
+        self.outside = os.path.join(self.temp_dir.name, 'outside')
+        os.makedirs(self.outside)
+
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
+    def test_clear_cache_namespace(self):
+        clear_cache('ncbi')
+        self.assertEqual(os.listdir(self.cache_dir), ['silva-taxonomy'])
+
+    def test_clear_cache_all(self):
+        clear_cache()
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertTrue(os.path.isdir(self.outside))
+
+    def test_clear_cache_unknown_namespace(self):
+        for namespace in ['..', self.outside, os.path.join('ncbi', '..')]:
+            with self.assertRaisesRegex(ValueError, 'Unknown cache namespace'):
+                clear_cache(namespace)
+        self.assertTrue(os.path.isdir(self.outside))
+        self.assertEqual(sorted(os.listdir(self.cache_dir)),
+                         ['ncbi', 'silva-taxonomy'])
+
+    def test_main_clear_unknown_namespace(self):
+        with self.assertRaises(SystemExit):
+            main(['clear', '..'])
+        self.assertTrue(os.path.isdir(self.outside))
@@ -7,6 +7,7 @@
 # ----------------------------------------------------------------------------
 
 import os
+from unittest.mock import patch
 
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugins import rescript
@@ -25,6 +26,10 @@ class TestPipelines(TestPluginBase):
 
     def setUp(self):
         super().setUp()
+        # keep any cache entries out of the user's cache
+        self.env = patch.dict(os.environ, {
+            'RESCRIPT_CACHE_DIR': os.path.join(self.temp_dir.name, 'cache')})
+        self.env.start()
 
         # drop feature C1b because it is missing species level
         self.taxa_series = pd.read_csv(
@@ -39,6 +44,10 @@ class TestPipelines(TestPluginBase):
             '; s__brevis', '').str.replace('; s__vaginalis', '').str.replace(
                 '; s__pseudocasei', '').sort_index()
 
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
     def test_evaluate_cross_validate_k3(self):
         exp, obs, _ = rescript.actions.evaluate_cross_validate(
             self.seqs, self.taxa, k=3)
@@ -68,6 +77,18 @@ class TestPipelines(TestPluginBase):
         pdt.assert_series_equal(
             exp_obs, obs.view(pd.Series).sort_index(), check_names=False)
 
+    def test_split_fasta(self):
+        train, test = cross_validate._split_fasta(
+            self.seqs, {'A1', 'B1'}, {'C1a'})
+        exp = self.seqs.view(pd.Series)
+        obs = train.view(pd.Series)
+        self.assertEqual(list(obs.index), ['A1', 'B1'])
+        self.assertEqual([str(s) for s in obs],
+                         [str(exp['A1']), str(exp['B1'])])
+        obs = test.view(pd.Series)
+        self.assertEqual(list(obs.index), ['C1a'])
+        self.assertEqual(str(obs['C1a']), str(exp['C1a']))
+
     def test_evaluate_fit_classifier(self):
         # exp species should equal the input taxonomy when k='disable'
         classifier, evaluation, obs = rescript.actions.evaluate_fit_classifier(
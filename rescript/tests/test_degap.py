@@ -8,11 +8,13 @@
 
 
 import qiime2
+import skbio
 from qiime2.plugin.testing import TestPluginBase
 from q2_types.feature_data import (AlignedDNAFASTAFormat, AlignedDNAIterator,
                                    DNAIterator)
 
-from rescript.degap import degap_seqs
+from rescript.degap import (degap_seqs, trim_alignment_columns,
+                            _profile_alignment_gaps)
 
 
 import_data = qiime2.Artifact.import_data
@@ -24,9 +26,7 @@ class TestDegapSeq(TestPluginBase):
     def setUp(self):
         super().setUp()
         input_fp = self.get_data_path('degap-test-alignment.fasta')
-        self.alignedseqs = AlignedDNAFASTAFormat(
-                                input_fp, mode='r').view(
-                                AlignedDNAIterator)
+        self.alignedseqs = AlignedDNAFASTAFormat(input_fp, mode='r')
 
     def test_degap_seqs(self):
         #  remove all '-' and '.' chars.
@@ -76,3 +76,92 @@ class TestDegapSeq(TestPluginBase):
                            'GTGTGTGAAGAAGGCCTTTTGGTTGTAAAGCACTTTAAGTGGGGAGGA'
                            'AAAGCTTGTGGTTAA')}
         self.assertEqual(obs_seqs, exp_seqs)
+
+    def test_degap_seqs_matches_skbio_degap(self):
+        # byte-level degapping must match skbio's degap for every record
+        obs_seqs = {seq.metadata['id']: str(seq)
+                    for seq in degap_seqs(self.alignedseqs).view(DNAIterator)}
+        exp_seqs = {}
+        for seq in self.alignedseqs.view(AlignedDNAIterator):
+            dg_seq = seq.degap()
+            if len(dg_seq) >= 1:
+                exp_seqs[seq.metadata['id']] = str(dg_seq)
+        self.assertEqual(obs_seqs, exp_seqs)
+
+    def test_degap_seqs_multiline_records_and_descriptions(self):
+        aligned = AlignedDNAFASTAFormat()
+        with aligned.open() as fh:
+            fh.write('>s1 first\tseq\nAC--GT\n..ACGT\n>s2\nA-C-G-\nT..\n')
+        obs = degap_seqs(aligned)
+        with open(str(obs)) as fh:
+            self.assertEqual(fh.read(),
+                             '>s1 first\tseq\nACGTACGT\n>s2\nACGT\n')
+        exp = [(s.metadata['id'], s.metadata['description'], str(s))
+               for s in skbio.read(str(obs), format='fasta')]
+        self.assertEqual(exp, [('s1', 'first\tseq', 'ACGTACGT'),
+                               ('s2', '', 'ACGT')])
+
+
+class TestTrimAlignmentColumns(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.aligned = AlignedDNAFASTAFormat()
+        with self.aligned.open() as fh:
+            fh.write('>s1\nA-C.GT\n>s2\nA--.G-\n>s3\nAT-.GT\n>s4\nA-C-GT\n')
+
+    def _trimmed(self, **kwargs):
+        obs = trim_alignment_columns(self.aligned, **kwargs)
+        return {seq.metadata['id']: str(seq)
+                for seq in obs.view(AlignedDNAIterator)}
+
+    def test_profile_alignment_gaps(self):
+        gap_counts, n_records = _profile_alignment_gaps(str(self.aligned))
+        self.assertEqual(gap_counts.tolist(), [0, 3, 2, 4, 0, 1])
+        self.assertEqual(n_records, 4)
+
+    def test_profile_alignment_gaps_unequal_lengths(self):
+        aligned = AlignedDNAFASTAFormat()
+        with aligned.open() as fh:
+            fh.write('>s1\nA-C.GT\n>s2\nA--.G\n')
+        with self.assertRaisesRegex(ValueError, 's2 is 5 characters'):
+            _profile_alignment_gaps(str(aligned))
+
+    def test_trim_alignment_columns_by_gap_frequency(self):
+        obs = self._trimmed(max_gap_frequency=0.5)
+        self.assertEqual(obs, {'s1': 'ACGT', 's2': 'A-G-', 's3': 'A-GT',
+                               's4': 'ACGT'})
+        # all-gap columns only
+        obs = self._trimmed(max_gap_frequency=0.99)
+        self.assertEqual(obs, {'s1': 'A-CGT', 's2': 'A--G-', 's3': 'AT-GT',
+                               's4': 'A-CGT'})
+
+    def test_trim_alignment_columns_by_position(self):
+        obs = self._trimmed(position_start=2, position_end=4)
+        self.assertEqual(obs, {'s1': '-C.', 's2': '--.', 's3': 'T-.',
+                               's4': '-C-'})
+        obs = self._trimmed(position_start=5)
+        self.assertEqual(obs, {'s1': 'GT', 's2': 'G-', 's3': 'GT',
+                               's4': 'GT'})
+
+    def test_trim_alignment_columns_by_position_and_gap_frequency(self):
+        obs = self._trimmed(max_gap_frequency=0.5, position_end=4)
+        self.assertEqual(obs, {'s1': 'AC', 's2': 'A-', 's3': 'A-',
+                               's4': 'AC'})
+
+    def test_trim_alignment_columns_no_criteria(self):
+        with self.assertRaisesRegex(ValueError, 'No trimming criteria'):
+            trim_alignment_columns(self.aligned)
+
+    def test_trim_alignment_columns_all_columns_trimmed(self):
+        with self.assertRaisesRegex(ValueError, 'All alignment columns'):
+            trim_alignment_columns(self.aligned, max_gap_frequency=0.0,
+                                   position_start=2, position_end=4)
+
+    def test_trim_alignment_columns_invalid_positions(self):
+        with self.assertRaisesRegex(ValueError, 'Invalid trimming positions'):
+            trim_alignment_columns(self.aligned, position_start=4,
+                                   position_end=2)
+        with self.assertRaisesRegex(ValueError, 'Invalid trimming positions'):
+            trim_alignment_columns(self.aligned, position_start=7)
@@ -6,13 +6,17 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+from unittest.mock import patch
+
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugins import rescript
 import qiime2
 import pandas as pd
 import pandas.util.testing as pdt
 
-from rescript.dereplicate import _backfill_taxonomy
+from rescript.dereplicate import (_backfill_taxonomy, _parse_uc,
+                                  _validate_ids_in_taxa)
 
 
 import_data = qiime2.Artifact.import_data
@@ -23,6 +27,10 @@ class TestDerep(TestPluginBase):
 
     def setUp(self):
         super().setUp()
+        # keep any cache entries out of the user's cache
+        self.env = patch.dict(os.environ, {
+            'RESCRIPT_CACHE_DIR': os.path.join(self.temp_dir.name, 'cache')})
+        self.env.start()
 
         self.dereplicate = rescript.actions.dereplicate
 
@@ -37,6 +45,10 @@ class TestDerep(TestPluginBase):
             'FeatureData[Taxonomy]', self.get_data_path(
                 'derep-taxa-numericIDs.tsv'))
 
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
     def test_dereplicate_uniq(self):
         seqs, taxa, = self.dereplicate(
             self.seqs, self.taxa, mode='uniq', rank_handles='disable')
@@ -284,6 +296,23 @@ class TestDerep(TestPluginBase):
                          mode='majority')
         self.assertTrue(True)
 
+    def test_dereplicate_ids_missing_from_taxonomy(self):
+        taxa = self.taxa.view(pd.Series).drop(['B2', 'A3'])
+        taxa = import_data('FeatureData[Taxonomy]', taxa)
+        for mode in ['uniq', 'lca', 'majority']:
+            with self.assertRaisesRegex(
+                    ValueError, 'missing from the taxonomy: A3, B2$'):
+                self.dereplicate(self.seqs, taxa, mode=mode)
+
+    def test_validate_ids_in_taxa(self):
+        uc = _parse_uc(self.get_data_path('derep-test.uc'))
+        taxa = pd.DataFrame({'Taxon': ['k__a'] * 6},
+                            index=['A1', 'A2', 'A3', 'B1', 'B2', 'C1'])
+        _validate_ids_in_taxa(uc['seqID'], taxa)
+        with self.assertRaisesRegex(
+                ValueError, 'missing from the taxonomy: A2, B2$'):
+            _validate_ids_in_taxa(uc['seqID'], taxa.drop(['A2', 'B2']))
+
     # Now test with backfilling. These parameters were chosen to set up a
     # variety of backfill levels.
     def test_dereplicate_lca_99_perc_backfill(self):
@@ -340,3 +369,15 @@ class TestDerep(TestPluginBase):
         exp_taxa = trimmed_taxa.apply(lambda x: x + ';n;u;t;s')
         backfilled_taxa = _backfill_series(trimmed_taxa, custom_rank_handles)
         pdt.assert_series_equal(backfilled_taxa, exp_taxa, check_names=False)
+
+    def test_parse_uc(self):
+        exp = pd.DataFrame({'seqID': ['A1', 'A2', 'B1', 'A3', 'B2'],
+                            'centroidID': ['A1', 'A1', 'B1', 'A1', 'B1']})
+        # parse in several chunks to check that they are combined correctly
+        for chunksize in [2, 100]:
+            obs = _parse_uc(self.get_data_path('derep-test.uc'), chunksize)
+            # both ID columns share the same categories
+            for col in ['seqID', 'centroidID']:
+                self.assertEqual(list(obs[col].cat.categories),
+                                 ['A1', 'A2', 'A3', 'B1', 'B2'])
+            pdt.assert_frame_equal(obs.astype(str), exp)
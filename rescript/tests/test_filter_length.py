@@ -7,14 +7,26 @@
 # ----------------------------------------------------------------------------
 
 
+import io
+from contextlib import redirect_stdout
+from unittest.mock import patch
+
+import numpy as np
+
 import pandas as pd
 import qiime2
 import pandas.util.testing as pdt
 from qiime2.plugin.testing import TestPluginBase
-from q2_types.feature_data import DNAIterator
+from q2_types.feature_data import DNAIterator, DNAFASTAFormat
 from qiime2.plugins import rescript
 
-from rescript.filter_length import _seq_length_within_range
+from rescript.filter_length import (filter_taxa, filter_seqs_length,
+                                    _seq_length_within_range,
+                                    _print_length_summary,
+                                    _taxon_length_thresholds,
+                                    _build_taxonomy_index,
+                                    _get_taxonomy_index,
+                                    _search_taxonomy_index)
 
 
 import_data = qiime2.Artifact.import_data
@@ -230,6 +242,47 @@ class TestSeqLengthWithinRange(TestPluginBase):
                 maxs=None, global_min=270, global_max=None))
 
 
+class TestTaxonLengthThresholds(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.taxa = pd.Series([
+            'k__Bacteria; p__Firmicutes; g__Paenibacillus',
+            'k__Bacteria; p__Proteobacteria',
+            'k__Archaea'])
+        self.labels = ['Bacteria', 'Paenibacillus']
+
+    def test_taxon_length_thresholds(self):
+        mins, maxs = _taxon_length_thresholds(
+            self.taxa, self.labels,
+            mins={'Bacteria': 250, 'Paenibacillus': 260},
+            maxs={'Bacteria': 300, 'Paenibacillus': 280},
+            global_min=None, global_max=None)
+        self.assertEqual(mins, [260, 250, 0])
+        self.assertEqual(maxs, [280, 300, float('inf')])
+
+    def test_taxon_length_thresholds_global(self):
+        mins, maxs = _taxon_length_thresholds(
+            self.taxa, self.labels, mins={'Bacteria': 250, 'Paenibacillus': 0},
+            maxs=None, global_min=100, global_max=290)
+        self.assertEqual(mins, [250, 250, 100])
+        self.assertEqual(maxs, [290, 290, 290])
+
+    def test_taxon_length_thresholds_match_seq_length_within_range(self):
+        mins = {'Bacteria': 250, 'Paenibacillus': 260}
+        maxs = {'Bacteria': 0, 'Paenibacillus': 270}
+        minlens, maxlens = _taxon_length_thresholds(
+            self.taxa, self.labels, mins, maxs, None, None)
+        for taxon, minlen, maxlen in zip(self.taxa, minlens, maxlens):
+            taxahits = [t for t in self.labels if t in taxon]
+            for seqlen in [0, 255, 265, 275]:
+                self.assertEqual(
+                    _seq_length_within_range(
+                        'A' * seqlen, taxahits, mins, maxs, None, None),
+                    maxlen >= seqlen >= minlen)
+
+
 # This method is just a vsearch wrapper with basic validation, so save on tests
 class TestFilterGlobally(TestPluginBase):
     package = 'rescript.tests'
@@ -300,6 +353,73 @@ class TestFilterGlobally(TestPluginBase):
         exp_failed_ids = set()
         self.assertEqual(failed_ids, exp_failed_ids)
 
+    def test_filter_seqs_length_native_engine(self):
+        # filter out seqs < 270 nt (N = 4)
+        filtered, failed = rescript.actions.filter_seqs_length(
+            self.seqs, global_min=270, global_max=None, engine='native')
+        filtered_ids = {
+            seq.metadata['id'] for seq in filtered.view(DNAIterator)}
+        exp_filtered_ids = {'A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3',
+                            'B1a', 'B1b', 'C1', 'C2'}
+        self.assertEqual(filtered_ids, exp_filtered_ids)
+        failed_ids = {seq.metadata['id'] for seq in failed.view(DNAIterator)}
+        exp_failed_ids = {'C1a', 'C1b', 'C1c', 'C1d'}
+        self.assertEqual(failed_ids, exp_failed_ids)
+
+    def test_filter_seqs_length_engines_match(self):
+        for global_min, global_max in [
+                (270, None), (None, 280), (264, 291), (270, 280), (100, 300)]:
+            obs = {}
+            for engine in ['vsearch', 'native']:
+                filtered, failed = rescript.actions.filter_seqs_length(
+                    self.seqs, global_min=global_min, global_max=global_max,
+                    engine=engine)
+                obs[engine] = [
+                    {(seq.metadata['id'], str(seq)) for seq in
+                     seqs.view(DNAIterator)} for seqs in [filtered, failed]]
+            self.assertEqual(obs['vsearch'], obs['native'])
+
+    def _filter_seqs_length_output(self, **kwargs):
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            filter_seqs_length(self.seqs.view(DNAFASTAFormat), **kwargs)
+        return stdout.getvalue()
+
+    def test_filter_seqs_length_summary(self):
+        for engine in ['vsearch', 'native']:
+            # no summary is printed by default
+            self.assertEqual(self._filter_seqs_length_output(
+                global_min=270, engine=engine), '')
+            obs = self._filter_seqs_length_output(
+                global_min=270, engine=engine, length_summary=True)
+            self.assertIn('Sequences retained: 12 of 16\n', obs)
+            self.assertIn('Sequence length histogram (length: count):\n',
+                          obs)
+
+    def test_print_length_summary(self):
+        lengths = np.array([100, 101, 105, 109, 110, 150], dtype=np.int64)
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            _print_length_summary(lengths, 101, 110, bins=5)
+        exp = ('Sequences retained: 4 of 6\n'
+               'Sequence length histogram (length: count):\n'
+               '100-109: 4\n110-119: 1\n120-129: 0\n130-139: 0\n'
+               '140-150: 1\n')
+        self.assertEqual(stdout.getvalue(), exp)
+
+    def test_print_length_summary_few_lengths(self):
+        # bins are never narrower than a single length
+        stdout = io.StringIO()
+        with redirect_stdout(stdout):
+            _print_length_summary(
+                np.array([5, 5, 6], dtype=np.int64), None, None)
+            _print_length_summary(np.array([], dtype=np.int64), 1, None)
+        exp = ('Sequences retained: 3 of 3\n'
+               'Sequence length histogram (length: count):\n'
+               '5: 2\n6: 1\n'
+               'Sequences retained: 0 of 0\n')
+        self.assertEqual(stdout.getvalue(), exp)
+
 
 class TestFilterTaxa(TestPluginBase):
     package = 'rescript.tests'
@@ -379,3 +499,73 @@ class TestFilterTaxa(TestPluginBase):
         with self.assertRaisesRegex(ValueError, "All features were filtered"):
             filtered, = rescript.actions.filter_taxa(
                 self.taxa, exclude=['Bacteria'])
+
+    def test_filter_taxa_by_include_rank_handle(self):
+        # o__Lactobacillales does not contain "Bacill", but c__Bacilli does
+        filtered, = rescript.actions.filter_taxa(
+            self.taxa, include=['Bacill'], rank_handle='o__')
+        self.assertEqual(list(filtered.view(pd.Series).index),
+                         ['A1', 'A2', 'A3', 'A4', 'A5'])
+
+    def test_filter_taxa_by_exclude_rank_handle(self):
+        # Pediococcus is excluded at the order level, but not the genus level
+        filtered, = rescript.actions.filter_taxa(
+            self.taxa, exclude=['Lacto'], rank_handle='g__')
+        self.assertEqual(
+            list(filtered.view(pd.Series).index),
+            ['A1', 'A2', 'A3', 'A4', 'A5', 'C1', 'C2', 'C1a', 'C1b', 'C1c',
+             'C1d'])
+
+
+class TestTaxonomyIndex(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.taxa = pd.Series(
+            ['k__Bacteria; p__Firmicutes; g__Bacillus',
+             'k__Bacteria; p__Firmicutes; g__Paenibacillus',
+             'k__Bacteria; p__Firmicutes; g__Bacillus',
+             'k__Bacteria; p__Bacillus'],
+            index=['a', 'b', 'c', 'd'])
+
+    def test_search_taxonomy_index(self):
+        index = _build_taxonomy_index(self.taxa)
+        self.assertEqual(len(index['taxa']), 3)
+        obs = _search_taxonomy_index(index, ['Bacillus'])
+        self.assertEqual(obs.tolist(), [True, False, True, True])
+        obs = _search_taxonomy_index(index, ['Bacillus'], 'g__')
+        self.assertEqual(obs.tolist(), [True, False, True, False])
+        obs = _search_taxonomy_index(index, ['acillus', 'x'], 'g__')
+        self.assertEqual(obs.tolist(), [True, True, True, False])
+        # matches are recorded for the unique taxonomy strings
+        self.assertEqual(
+            index['matches'][(('Bacillus',), 'g__')].tolist(),
+            [True, False, False])
+
+    def test_search_taxonomy_index_matches_are_bounded(self):
+        index = _build_taxonomy_index(self.taxa)
+        with patch('rescript.filter_length._TAXONOMY_MATCHES_CACHE_SIZE', 2):
+            for term in ['Bacillus', 'Firmicutes', 'Bacteria']:
+                _search_taxonomy_index(index, [term])
+            # reusing a search result makes it the most recent
+            _search_taxonomy_index(index, ['Firmicutes'])
+            _search_taxonomy_index(index, ['Paenibacillus'])
+        self.assertEqual(list(index['matches']),
+                         [(('Firmicutes',), None), (('Paenibacillus',), None)])
+
+    def test_filter_taxa_ids_only_skips_index(self):
+        ids = pd.Index(['a', 'd'], name='Feature ID')
+        ids = qiime2.Metadata(pd.DataFrame(index=ids))
+        with patch('rescript.filter_length._get_taxonomy_index') as index:
+            obs = filter_taxa(self.taxa, ids_to_keep=ids)
+        index.assert_not_called()
+        self.assertEqual(list(obs.index), ['a', 'd'])
+
+    def test_get_taxonomy_index_is_cached(self):
+        index = _get_taxonomy_index(self.taxa)
+        self.assertIs(_get_taxonomy_index(self.taxa.copy()), index)
+        # a different taxonomy gets its own index
+        taxa = self.taxa.copy()
+        taxa['d'] = 'k__Bacteria'
+        self.assertIsNot(_get_taxonomy_index(taxa), index)
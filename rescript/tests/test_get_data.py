@@ -6,15 +6,26 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
+import gzip
+import hashlib
+import io
+import pathlib
 import qiime2
 import pkg_resources
+import pandas as pd
+import pandas.util.testing as pdt
 from qiime2.plugin.testing import TestPluginBase
 from qiime2.plugins import rescript
 from rescript.get_data import (_assemble_silva_data_urls,
-                               _retrieve_data_from_silva)
+                               _retrieve_data_from_silva, _download_file,
+                               _download_silva_file, _mirror_url,
+                               _import_silva_file, _gzip_decompress,
+                               _SILVA_BASE_URL)
+from rescript.types import RNASequencesDirectoryFormat
 from rescript.plugin_setup import _SILVA_VERSIONS, _SILVA_TARGETS
 from urllib.request import urlopen
-from urllib.error import HTTPError
+from urllib.error import HTTPError, URLError
 from unittest.mock import patch
 
 
@@ -46,7 +57,9 @@ class TestGetSILVA(TestPluginBase):
             ('taxa', 'https://www.arb-silva.de/fileadmin/silva_databases/'
                      'release_138/Exports/taxonomy/tax_slv_ssu_138.tre.gz',
              'Phylogeny[Rooted]')]
-        _retrieve_data_from_silva(queries)
+        cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        with patch.dict(os.environ, {'RESCRIPT_CACHE_DIR': cache_dir}):
+            _retrieve_data_from_silva(queries)
         self.assertTrue(True)
 
     # This tests the full get_silva_data pipeline, using mock data and
@@ -56,7 +69,8 @@ class TestGetSILVA(TestPluginBase):
     # to mock data download and slip in fake data in its place.
     def test_get_silva_data(self):
 
-        def _fake_data_on_demand(give_me_anything_i_shall_ignore_it):
+        def _fake_data_on_demand(give_me_anything_i_shall_ignore_it,
+                                 mirror=None):
             tr = qiime2.Artifact.import_data(
                 'FeatureData[SILVATaxonomy]',
                 pkg_resources.resource_filename(
@@ -71,8 +85,227 @@ class TestGetSILVA(TestPluginBase):
                          'taxonomy ranks': tr}
             return fake_dict
 
+        cache_dir = os.path.join(self.temp_dir.name, 'cache')
         with patch('rescript.get_data._retrieve_data_from_silva',
-                   new=_fake_data_on_demand):
-            rescript.actions.get_silva_data(
+                   new=_fake_data_on_demand), \
+                patch.dict(os.environ, {'RESCRIPT_CACHE_DIR': cache_dir}):
+            _, taxonomy = rescript.actions.get_silva_data(
                 version='132', target='SSURef_NR99', download_sequences=False)
-            self.assertTrue(True)
+            # the parsed taxonomy is reused from the cache on the next run,
+            # and its provenance still records the parse_silva_taxonomy step
+            _, cached_taxonomy = rescript.actions.get_silva_data(
+                version='132', target='SSURef_NR99', download_sequences=False)
+            self.assertEqual(
+                len(os.listdir(os.path.join(cache_dir, 'silva-taxonomy'))), 1)
+            pdt.assert_series_equal(cached_taxonomy.view(pd.Series),
+                                    taxonomy.view(pd.Series))
+            prov = pathlib.Path(
+                str(cached_taxonomy._archiver.provenance_dir))
+            actions = [p.read_text() for p in prov.glob('**/action.yaml')]
+            self.assertTrue(any('action: parse_silva_taxonomy' in a
+                                for a in actions))
+
+
+class _FakeResponse(io.BytesIO):
+    def __init__(self, data, code, headers=None):
+        super().__init__(data)
+        self.code = code
+        self.headers = headers or {}
+
+    def getcode(self):
+        return self.code
+
+
+class TestSILVADownload(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.env = patch.dict(
+            os.environ, {'RESCRIPT_CACHE_DIR': self.cache_dir})
+        self.env.start()
+        # set up a local mirror of the SILVA databases
+        self.mirror = os.path.join(self.temp_dir.name, 'mirror')
+        taxonomy_dir = os.path.join(
+            self.mirror, 'release_138', 'Exports', 'taxonomy')
+        os.makedirs(taxonomy_dir)
+        with open(self.get_data_path('taxid_tree.tre'), 'rb') as tree:
+            self.data = gzip.compress(tree.read())
+        self.tree_fp = os.path.join(taxonomy_dir, 'tax_slv_ssu_138.tre.gz')
+        with open(self.tree_fp, 'wb') as out:
+            out.write(self.data)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        with open(self.tree_fp + '.md5', 'w') as out:
+            out.write(self.md5 + '  tax_slv_ssu_138.tre.gz\n')
+        self.query = (_SILVA_BASE_URL +
+                      'release_138/Exports/taxonomy/tax_slv_ssu_138.tre.gz')
+        self.download_dir = os.path.join(self.temp_dir.name, 'downloads')
+        os.makedirs(self.download_dir)
+
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
+    def test_mirror_url(self):
+        self.assertEqual(_mirror_url(self.query), self.query)
+        self.assertEqual(
+            _mirror_url(self.query, 'file:///silva/'),
+            'file:///silva/release_138/Exports/taxonomy/'
+            'tax_slv_ssu_138.tre.gz')
+        self.assertEqual(
+            _mirror_url(self.query, self.mirror),
+            pathlib.Path(self.tree_fp).resolve().as_uri())
+
+    def test_retrieve_data_from_silva_mirror(self):
+        queries = [('taxonomy tree', self.query, 'Phylogeny[Rooted]')]
+        obs = _retrieve_data_from_silva(queries, mirror=self.mirror)
+        self.assertEqual(list(obs.keys()), ['taxonomy tree'])
+        self.assertEqual(str(obs['taxonomy tree'].type), 'Phylogeny[Rooted]')
+        # completed downloads are removed from the download directory
+        self.assertEqual(
+            os.listdir(os.path.join(self.cache_dir, 'silva-downloads')), [])
+
+    def test_download_silva_file(self):
+        obs = _download_silva_file(self.query, self.download_dir, self.mirror)
+        self.assertEqual(
+            obs, os.path.join(self.download_dir, 'tax_slv_ssu_138.tre.gz'))
+        with open(obs, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(os.listdir(self.download_dir),
+                         ['tax_slv_ssu_138.tre.gz'])
+
+    def test_download_silva_file_md5_mismatch(self):
+        with open(self.tree_fp + '.md5', 'w') as out:
+            out.write('0' * 32 + '  tax_slv_ssu_138.tre.gz\n')
+        with self.assertRaisesRegex(ValueError, 'md5 sums do not match'):
+            _download_silva_file(self.query, self.download_dir, self.mirror)
+        # a corrupt download is not kept around to be resumed
+        self.assertEqual(os.listdir(self.download_dir), [])
+
+    def test_download_silva_file_missing_md5(self):
+        os.remove(self.tree_fp + '.md5')
+        with self.assertWarnsRegex(UserWarning, 'No md5 file'):
+            _download_silva_file(self.query, self.download_dir, self.mirror)
+
+    def test_download_silva_file_md5_not_retrieved(self):
+        # only a missing md5 file skips validation, other errors are raised
+        errors = [URLError('timed out'),
+                  HTTPError(self.query + '.md5', 503, 'unavailable', {},
+                            None)]
+        for error in errors:
+            with patch('rescript.get_data.urlretrieve', side_effect=error):
+                with self.assertRaises(URLError):
+                    _download_silva_file(
+                        self.query, self.download_dir, self.mirror)
+
+    def test_download_silva_file_md5_http_404(self):
+        error = HTTPError(self.query + '.md5', 404, 'not found', {}, None)
+        with patch('rescript.get_data.urlretrieve', side_effect=error):
+            with self.assertWarnsRegex(UserWarning, 'No md5 file'):
+                _download_silva_file(
+                    self.query, self.download_dir, self.mirror)
+
+    def _write_partial(self, destination, data, validator='"v1"'):
+        with open(destination + '.part', 'wb') as out:
+            out.write(data)
+        if validator is not None:
+            with open(destination + '.part.validator', 'w') as out:
+                out.write(validator)
+
+    def test_download_file_resume(self):
+        destination = os.path.join(self.download_dir, 'tree.gz')
+        self._write_partial(destination, self.data[:10])
+
+        def _partial_content(request):
+            self.assertEqual(request.get_header('Range'), 'bytes=10-')
+            self.assertEqual(request.get_header('If-range'), '"v1"')
+            return _FakeResponse(self.data[10:], 206, {'ETag': '"v1"'})
+
+        with patch('rescript.get_data.urlopen', new=_partial_content):
+            obs = _download_file('https://silva/tree.gz', destination,
+                                 chunksize=7)
+        self.assertEqual(obs, self.md5)
+        with open(destination, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(os.listdir(self.download_dir), ['tree.gz'])
+
+    def test_download_file_resume_file_changed(self):
+        destination = os.path.join(self.download_dir, 'tree.gz')
+        self._write_partial(destination, b'old version')
+
+        # If-Range does not match, so the server sends the whole new file
+        def _full_content(request):
+            self.assertEqual(request.get_header('If-range'), '"v1"')
+            return _FakeResponse(self.data, 200, {'ETag': '"v2"'})
+
+        with patch('rescript.get_data.urlopen', new=_full_content):
+            obs = _download_file('https://silva/tree.gz', destination)
+        self.assertEqual(obs, self.md5)
+        with open(destination, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+
+    def test_download_file_resume_validator_mismatch(self):
+        destination = os.path.join(self.download_dir, 'tree.gz')
+        self._write_partial(destination, b'old version')
+        requests = []
+
+        # a server that ignores If-Range sends part of the new file
+        def _content(request):
+            requests.append(request.get_header('Range'))
+            if request.get_header('Range'):
+                return _FakeResponse(self.data[11:], 206, {'ETag': '"v2"'})
+            return _FakeResponse(self.data, 200, {'ETag': '"v2"'})
+
+        with patch('rescript.get_data.urlopen', new=_content):
+            obs = _download_file('https://silva/tree.gz', destination)
+        self.assertEqual(requests, ['bytes=11-', None])
+        self.assertEqual(obs, self.md5)
+        with open(destination, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+
+    def test_download_file_no_validator(self):
+        destination = os.path.join(self.download_dir, 'tree.gz')
+        self._write_partial(destination, self.data[:10], validator=None)
+
+        # partial downloads that cannot be validated are not resumed
+        def _full_content(request):
+            self.assertIsNone(request.get_header('Range'))
+            return _FakeResponse(self.data, 200)
+
+        with patch('rescript.get_data.urlopen', new=_full_content):
+            obs = _download_file('https://silva/tree.gz', destination)
+        self.assertEqual(obs, self.md5)
+        with open(destination, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+
+    def test_download_file_resume_not_supported(self):
+        destination = os.path.join(self.download_dir, 'tree.gz')
+        self._write_partial(destination, b'stale data')
+        # servers that ignore the range request send the whole file
+        obs = _download_file(_mirror_url(self.query, self.mirror),
+                             destination)
+        self.assertEqual(obs, self.md5)
+        with open(destination, 'rb') as fh:
+            self.assertEqual(fh.read(), self.data)
+        self.assertEqual(os.listdir(self.download_dir), ['tree.gz'])
+
+    def test_gzip_decompress(self):
+        output_fp = os.path.join(self.download_dir, 'tree.tre')
+        _gzip_decompress(self.tree_fp, output_fp, chunksize=7)
+        with open(output_fp, 'rb') as obs:
+            with open(self.get_data_path('taxid_tree.tre'), 'rb') as exp:
+                self.assertEqual(obs.read(), exp.read())
+
+    def test_import_silva_file_sequences(self):
+        seqs = b'>a\nACGU\n>b\nUUUU\n'
+        fp = os.path.join(self.download_dir, 'seqs.fasta.gz')
+        for data in [gzip.compress(seqs), seqs]:
+            with open(fp, 'wb') as out:
+                out.write(data)
+            obs = _import_silva_file(
+                fp, 'FeatureData[RNASequence]', self.download_dir)
+            with open(os.path.join(
+                    str(obs.view(RNASequencesDirectoryFormat)),
+                    'rna-sequences.fasta'), 'rb') as fh:
+                self.assertEqual(fh.read(), seqs)
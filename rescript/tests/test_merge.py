@@ -13,6 +13,10 @@ import pandas as pd
 import numpy as np
 import pandas.util.testing as pdt
 
+from rescript._utilities import (
+    _find_consensus_batch, _find_lca, _find_lca_majority, _find_super_lca,
+    _collapse_substrings)
+
 
 import_data = qiime2.Artifact.import_data
 
@@ -433,3 +437,99 @@ class TestMergeTaxa(TestPluginBase):
             'unique2': 'k__Bacteria;p__;c__;o__;f__;g__;s__blah'}})
         pdt.assert_frame_equal(
             result.view(pd.DataFrame), exp, check_names=False)
+
+
+class TestFindConsensusBatch(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.taxa = [
+            ['k__Bacteria', 'p__Firmicutes', 'c__Bacilli'],
+            ['k__Bacteria', 'p__Firmicutes', 'c__Clostridia'],
+            ['k__Bacteria', 'p__Firmicutes', 'c__Bacilli', 'o__Bacillales'],
+            ['k__Bacteria', 'p__Proteobacteria'],
+            ['k__Bacteria', 'p__Proteobacteria', 'c__Gamma'],
+            ['k__Bacteria', 'p__Proteobacteria', 'c__Gammaproteobacteria'],
+            ['k__Archaea'],
+            ['k__Archaea', 'p__'],
+            ['k__Bacteria', 'p__Firmicutes'],
+            ['k__Bacteria', 'p__Firmicutes', 'c__Bacilli']]
+        self.groups = ['A', 'A', 'A', 'B', 'B', 'B', 'C', 'C', 'D', 'D']
+
+    def _expected(self, func):
+        exp = {}
+        for t, g in zip(self.taxa, self.groups):
+            exp.setdefault(g, []).append(t)
+        return {g: list(func(t)) for g, t in exp.items()}
+
+    def test_find_consensus_batch_lca(self):
+        obs = _find_consensus_batch(self.taxa, self.groups, mode='lca')
+        self.assertEqual(obs.to_dict(), self._expected(_find_lca))
+
+    def test_find_consensus_batch_majority(self):
+        obs = _find_consensus_batch(self.taxa, self.groups, mode='majority')
+        self.assertEqual(obs.to_dict(), self._expected(_find_lca_majority))
+
+    def test_find_consensus_batch_super(self):
+        obs = _find_consensus_batch(self.taxa, self.groups, mode='super')
+        self.assertEqual(obs.to_dict(), self._expected(_find_super_lca))
+
+    def test_find_consensus_batch_super_tied_superstrings(self):
+        # superstrings of the same length are chosen by their first
+        # occurrence within each group, regardless of other groups
+        self.taxa = [['k__a', 'g__Bacillus_B'],
+                     ['k__a', 'g__Bacillus_A'], ['k__a', 'g__Bacillus'],
+                     ['k__a', 'g__Bacillus'], ['k__a', 'g__Bacillus_B'],
+                     ['abc'], ['cab'], ['a'], ['a'], ['abc']]
+        self.groups = ['A', 'B', 'B', 'B', 'B', 'C', 'D', 'D', 'D', 'D']
+        obs = _find_consensus_batch(self.taxa, self.groups, mode='super')
+        exp = self._expected(_find_super_lca)
+        self.assertEqual(obs.to_dict(), exp)
+        self.assertEqual(exp['B'], ['k__a', 'g__Bacillus_A'])
+        self.assertEqual(exp['D'], ['cab'])
+
+
+class TestFindSuperLCA(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        lineage = ['k__Bacteria', 'p__Proteobacteria',
+                   'c__Gammaproteobacteria', 'o__Enterobacterales',
+                   'f__Enterobacteriaceae', 'g__Escherichia-Shigella']
+        # a large cluster of near-identical labels, as found when
+        # dereplicating thousands of E. coli/Shigella amplicons
+        self.taxa = [lineage + ['s__Escherichia_coli']] * 6000 + \
+            [lineage + ['s__Escherichia_coli_O157:H7']] * 2000 + \
+            [lineage + ['s__Shigella_flexneri']] * 3000 + \
+            [lineage[:5]] * 500
+        self.exp = lineage + ['s__Escherichia_coli_O157:H7']
+
+    def test_find_super_lca_large_cluster(self):
+        self.assertEqual(_find_super_lca(self.taxa), self.exp)
+
+    def test_find_lca_majority_large_cluster(self):
+        self.assertEqual(_find_lca_majority(self.taxa),
+                         self.exp[:-1] + ['s__Escherichia_coli'])
+
+    def test_find_super_lca_large_cluster_no_majority(self):
+        # E. coli and Shigella labels tie, so species is unresolved
+        taxa = self.taxa + [self.exp[:-1] + ['s__Shigella_flexneri']] * 5000
+        self.assertEqual(_find_super_lca(taxa), self.exp[:-1])
+
+    def test_find_consensus_batch_super_large_clusters(self):
+        taxa = self.taxa * 10
+        groups = np.repeat(np.arange(10), len(self.taxa))
+        obs = _find_consensus_batch(taxa, groups, mode='super')
+        self.assertEqual(obs.tolist(), [self.exp] * 10)
+
+    def test_collapse_substrings(self):
+        obs = _collapse_substrings(['a', 'ab', 'b', 'abc', 'xy', 'x', 'ba'])
+        self.assertEqual(obs, ['abc', 'abc', 'abc', 'abc', 'xy', 'xy', 'ba'])
+
+    def test_collapse_substrings_ties_resolved_by_input_order(self):
+        obs = _collapse_substrings(['a', 'ab', 'ca'])
+        self.assertEqual(obs, ['ab', 'ab', 'ca'])
+        obs = _collapse_substrings(['a', 'ca', 'ab'])
+        self.assertEqual(obs, ['ca', 'ca', 'ab'])
@@ -6,7 +6,16 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import io
+import os
+import threading
+import time
 import warnings
+from contextlib import closing
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from unittest.mock import patch
+from urllib.parse import urlparse, parse_qs
 
 import qiime2
 from qiime2 import Metadata
@@ -15,6 +24,10 @@ from qiime2.plugins import rescript
 from pandas import DataFrame
 from q2_types.feature_data import DNAIterator
 
+from rescript.ncbi import (_get, _TokenBucket, _get_rate_limiter,
+                           _checkpoint_db, _parse_records, get_ncbi_data,
+                           get_nuc_for_accs, get_nuc_for_query)
+
 import_data = qiime2.Artifact.import_data
 
 
@@ -23,6 +36,11 @@ class TestNCBI(TestPluginBase):
 
     def setUp(self):
         super().setUp()
+        # keep checkpoints and cached taxonomies out of the user's cache, so
+        # that taxonomies are always fetched
+        self.env = patch.dict(os.environ, {
+            'RESCRIPT_CACHE_DIR': os.path.join(self.temp_dir.name, 'cache')})
+        self.env.start()
 
         self.get_ncbi_data = rescript.methods.get_ncbi_data
 
@@ -33,6 +51,10 @@ class TestNCBI(TestPluginBase):
         self.non_standard_taxa = import_data(
             'FeatureData[Taxonomy]', self.get_data_path('ns-ncbi-taxa.tsv'))
 
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
     def test_get_ncbi_data_accession_ids_no_rank_propagation(self):
         df = DataFrame(index=['M59083.2', 'AJ234039.1'])
         df.index.name = 'id'
@@ -128,3 +150,390 @@ class TestNCBI(TestPluginBase):
             'sf__; f__Boletaceae; fs__Boletoideae; g__Boletus; '
             's__edulis; ssb__'
         )
+
+
+_TSEQ = ('<TSeq><TSeq_seqtype value="nucleotide"/>'
+         '<TSeq_accver>{0}</TSeq_accver><TSeq_taxid>{1}</TSeq_taxid>'
+         '<TSeq_sequence>{2}</TSeq_sequence></TSeq>')
+
+_TAXON = ('<Taxon><TaxId>{0}</TaxId><ScientificName>{1}</ScientificName>'
+          '<GeneticCode><GCId>11</GCId></GeneticCode>'
+          '<Division>{2}</Division><LineageEx>{3}</LineageEx></Taxon>')
+
+_LINEAGE_TAXON = ('<Taxon><TaxId>0</TaxId><ScientificName>{1}</ScientificName>'
+                  '<Rank>{0}</Rank></Taxon>')
+
+
+class _EntrezHandler(BaseHTTPRequestHandler):
+    '''Local stand-in for the Entrez E-utilities.'''
+    # support keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(body.encode())))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        params = parse_qs(self.rfile.read(length).decode())
+        self.server.log.append(('epost', params, time.monotonic()))
+        self.server.ports.add(self.client_address[1])
+        self.server.posted = params['id'][0].split(',')
+        self._respond('<ePostResult><QueryKey>1</QueryKey>'
+                      '<WebEnv>posted</WebEnv></ePostResult>')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        eutil = url.path.split('/')[-1].split('.')[0]
+        self.server.log.append((eutil, params, time.monotonic()))
+        self.server.ports.add(self.client_address[1])
+        records = self.server.records
+        if eutil == 'esearch':
+            self._respond('<eSearchResult><Count>{0}</Count>'
+                          '<QueryKey>1</QueryKey><WebEnv>searched</WebEnv>'
+                          '</eSearchResult>'.format(self.server.count))
+            return
+        if params['db'] == ['taxonomy']:
+            self._respond('<TaxaSet>' + ''.join(_TAXON.format(
+                taxid, self.server.taxa[taxid][0], self.server.taxa[taxid][1],
+                ''.join(_LINEAGE_TAXON.format(*rank)
+                        for rank in self.server.taxa[taxid][2]))
+                for taxid in self.server.posted) + '</TaxaSet>')
+            return
+        if params['WebEnv'] == ['posted']:
+            records = [r for r in records if r[0] in self.server.posted or
+                       r[0].split('.')[0] in self.server.posted]
+        retstart = int(params['retstart'][0])
+        transient_errors = self.server.transient_errors.get(retstart)
+        if transient_errors:
+            self._respond('<eFetchResult><ERROR>try again</ERROR>'
+                          '</eFetchResult>', status=transient_errors.pop(0))
+            return
+        if retstart in self.server.dropped_pages:
+            # close the connection without a response
+            self.close_connection = True
+            return
+        if retstart in self.server.truncated_pages:
+            self._respond('<TSeqSet><TSeq>')
+            return
+        if retstart in self.server.bad_gateway_pages:
+            self._respond('<html>Bad Gateway</html>', status=502)
+            return
+        if retstart in self.server.failing_pages:
+            self._respond('<eFetchResult><ERROR>page failed</ERROR>'
+                          '</eFetchResult>', status=400)
+            return
+        page = records[retstart:retstart + int(params['retmax'][0])]
+        self._respond('<TSeqSet>' + ''.join(
+            _TSEQ.format(*r) for r in page) + '</TSeqSet>')
+
+
+class _EntrezServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestEntrezFetch(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.server = _EntrezServer(('127.0.0.1', 0), _EntrezHandler)
+        self.server.records = [('A{0}.1'.format(i), str(i % 3), 'ACGT' * i)
+                               for i in range(1, 8)]
+        self.server.count = len(self.server.records)
+        self.server.taxa = {
+            '0': ('Escherichia coli', 'Bacteria',
+                  [('phylum', 'Proteobacteria'), ('genus', 'Escherichia')]),
+            '1': ('Bacillus subtilis', 'Bacteria', [('genus', 'Bacillus')]),
+            '2': ('unclassified Fungi', 'Plants and Fungi', [])}
+        self.server.failing_pages = []
+        self.server.bad_gateway_pages = []
+        self.server.dropped_pages = []
+        self.server.truncated_pages = []
+        self.server.transient_errors = {}
+        self.server.log = []
+        self.server.ports = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True,
+                         kwargs={'poll_interval': 0.01}).start()
+        self.patches = [
+            patch('rescript.ncbi._ENTREZ_BASE_URL',
+                  'http://127.0.0.1:{0}/'.format(self.server.server_port)),
+            patch('rescript.ncbi._EFETCH_RETMAX', 2),
+            # do not slow the tests down to the real Entrez rate limits
+            patch('rescript.ncbi._ENTREZ_RATE', 1000),
+            patch('rescript.ncbi._ENTREZ_RATE_WITH_API_KEY', 1000),
+            patch('rescript.ncbi._ENTREZ_BACKOFF', 0.01),
+            patch.dict(os.environ),
+        ]
+        for p in self.patches:
+            p.start()
+        os.environ.pop('NCBI_API_KEY', None)
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        os.environ['RESCRIPT_CACHE_DIR'] = self.cache_dir
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        super().tearDown()
+
+    def _efetch_log(self):
+        return [params for eutil, params, _ in self.server.log
+                if eutil == 'efetch']
+
+    def test_get_nuc_for_query(self):
+        obs = list(get_nuc_for_query('anything'))
+        self.assertEqual(obs, self.server.records)
+        self.assertEqual(obs[2], ('A3.1', '0', 'ACGT' * 3))
+        # pages are requested with an explicit size
+        efetches = self._efetch_log()
+        self.assertEqual(sorted(int(p['retstart'][0]) for p in efetches),
+                         [0, 2, 4, 6])
+        self.assertTrue(all(p['retmax'] == ['2'] for p in efetches))
+
+    def test_get_nuc_for_accs(self):
+        obs = list(get_nuc_for_accs(['A2.1', 'A5.1', 'A7.1']))
+        self.assertEqual(obs, [('A2.1', '2', 'ACGT' * 2),
+                               ('A5.1', '2', 'ACGT' * 5),
+                               ('A7.1', '1', 'ACGT' * 7)])
+
+    def test_get_ncbi_data(self):
+        seqs, taxa = get_ncbi_data(query='anything',
+                                   ranks=['kingdom', 'phylum', 'genus'])
+        with open(str(seqs)) as fh:
+            self.assertEqual(fh.read(), ''.join(
+                '>{0}\n{2}\n'.format(*r) for r in self.server.records))
+        self.assertEqual(taxa['Taxon']['A3.1'],
+                         'k__Bacteria; p__Proteobacteria; g__Escherichia')
+        self.assertEqual(taxa['Taxon']['A1.1'],
+                         'k__Bacteria; p__Bacteria; g__Bacillus')
+        self.assertEqual(taxa['Taxon']['A2.1'],
+                         'k__Plants and Fungi; p__Plants and Fungi; '
+                         'g__unclassified')
+        # each taxid is only fetched once
+        self.assertEqual(sorted(self.server.posted), ['0', '1', '2'])
+
+    def _posted_taxids(self):
+        return [params['id'][0].split(',') for eutil, params, _ in
+                self.server.log if eutil == 'epost' and
+                params['db'] == ['taxonomy']]
+
+    def test_get_ncbi_data_cached_taxonomies(self):
+        _, exp = get_ncbi_data(query='anything')
+        self.assertEqual(self._posted_taxids(), [['0', '1', '2']])
+        # cached taxonomies are not fetched again
+        self.server.records.append(('A8.1', '3', 'ACGT'))
+        self.server.count += 1
+        self.server.taxa['3'] = ('Bacillus', 'Bacteria', [])
+        _, obs = get_ncbi_data(query='anything')
+        self.assertEqual(self._posted_taxids(), [['0', '1', '2'], ['3']])
+        self.assertEqual(obs['Taxon'][:7].tolist(), exp['Taxon'].tolist())
+        # unless they have expired
+        with patch('rescript.ncbi._TAXONOMY_CACHE_TTL', -1):
+            get_ncbi_data(query='anything')
+        self.assertEqual(self._posted_taxids()[-1], ['0', '1', '2', '3'])
+
+    def test_get_missing_records(self):
+        self.server.count = 9
+        with self.assertRaisesRegex(RuntimeError,
+                                    '9 records were expected but only 7'):
+            list(_get(dict(db='nuccore', term='anything')))
+
+    def test_get_missing_accessions(self):
+        with self.assertRaisesRegex(RuntimeError,
+                                    'missing records were B1.1, B2.1'):
+            list(get_nuc_for_accs(['A2.1', 'B1.1', 'B2.1']))
+
+    def test_get_failed_page(self):
+        self.server.failing_pages = [4]
+        with self.assertRaisesRegex(
+                RuntimeError, '(?s)only 4 were received.*page failed'):
+            list(_get(dict(db='nuccore', term='anything')))
+
+    def test_get_retries_transient_errors(self):
+        self.server.transient_errors = {2: [503, 429], 6: [500]}
+        obs = list(get_nuc_for_query('anything'))
+        self.assertEqual(obs, self.server.records)
+        self.assertEqual(len(self._efetch_log()), 7)
+
+    def test_get_retries_exhausted(self):
+        self.server.transient_errors = {2: [503] * 3}
+        with patch('rescript.ncbi._ENTREZ_RETRIES', 2):
+            with self.assertRaisesRegex(
+                    RuntimeError, '(?s)only 2 were received.*try again'):
+                list(_get(dict(db='nuccore', term='anything')))
+
+    def test_get_retries_exhausted_non_entrez_error(self):
+        self.server.bad_gateway_pages = [2]
+        with patch('rescript.ncbi._ENTREZ_RETRIES', 1):
+            with self.assertRaisesRegex(
+                    RuntimeError, '(?s)Download did not finish.*'
+                                  'HTTP 502: <html>Bad Gateway</html>'):
+                list(_get(dict(db='nuccore', term='anything')))
+
+    def test_get_connection_failure(self):
+        self.server.count = 20
+        self.server.dropped_pages = list(range(0, 20, 2))
+        with patch('rescript.ncbi._ENTREZ_RETRIES', 1), \
+                patch('rescript.ncbi._EFETCH_THREADS', 1):
+            with self.assertRaisesRegex(
+                    RuntimeError, '(?s)Download did not finish.*'
+                                  'only 0 were received.*Request failed'):
+                list(_get(dict(db='nuccore', term='anything')))
+        # pending pages are cancelled instead of going through their retries
+        self.assertLessEqual(len(self._efetch_log()), 4)
+
+    def test_get_truncated_response(self):
+        self.server.truncated_pages = [2]
+        with self.assertRaisesRegex(
+                RuntimeError, '(?s)Download did not finish.*'
+                              'Could not parse the efetch response'):
+            list(_get(dict(db='nuccore', term='anything')))
+
+    def test_get_reuses_connections(self):
+        with patch('rescript.ncbi._EFETCH_THREADS', 1):
+            list(get_nuc_for_query('anything'))
+        self.assertEqual(len(self.server.log), 5)
+        self.assertEqual(len(self.server.ports), 1)
+
+    def _checkpointed_pages(self):
+        with closing(_checkpoint_db()) as db:
+            return db.execute('SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def test_get_resumes_query(self):
+        self.server.failing_pages = [4]
+        with patch('rescript.ncbi._EFETCH_THREADS', 1):
+            with self.assertRaisesRegex(RuntimeError, 'page failed'):
+                list(get_nuc_for_query('anything'))
+        self.assertGreaterEqual(self._checkpointed_pages(), 2)
+        self.server.failing_pages = []
+        self.server.log = []
+        obs = list(get_nuc_for_query('anything'))
+        self.assertEqual(obs, self.server.records)
+        # only the pages that were not downloaded yet are fetched
+        retstarts = [int(p['retstart'][0]) for p in self._efetch_log()]
+        self.assertIn(4, retstarts)
+        self.assertNotIn(0, retstarts)
+        self.assertNotIn(2, retstarts)
+        # the checkpoint is cleared once the download completes
+        self.assertEqual(self._checkpointed_pages(), 0)
+
+    def test_get_resumes_accessions(self):
+        accs = ['A1.1', 'A2.1', 'A3', 'A4.1', 'A5.1']
+        self.server.failing_pages = [2]
+        with patch('rescript.ncbi._EFETCH_THREADS', 1):
+            with self.assertRaisesRegex(RuntimeError, 'page failed'):
+                list(get_nuc_for_accs(accs))
+        self.server.failing_pages = []
+        self.server.log = []
+        obs = list(get_nuc_for_accs(accs))
+        self.assertEqual(sorted(r[0] for r in obs),
+                         ['A1.1', 'A2.1', 'A3.1', 'A4.1', 'A5.1'])
+        # only the accessions that were not downloaded yet are fetched
+        posted = self.server.posted
+        self.assertNotIn('A1.1', posted)
+        self.assertNotIn('A2.1', posted)
+        self.assertIn('A3', posted)
+        self.assertIn('A4.1', posted)
+        self.assertEqual(self._checkpointed_pages(), 0)
+
+    def test_get_resumes_accessions_after_early_failure(self):
+        accs = ['A1.1', 'A2.1', 'A3.1', 'A4.1', 'A5.1', 'A6.1']
+        # the first page fails, while the later pages in flight are saved
+        self.server.failing_pages = [0]
+        with self.assertRaisesRegex(RuntimeError, 'page failed'):
+            list(get_nuc_for_accs(accs))
+        self.assertEqual(self._checkpointed_pages(), 2)
+        self.server.failing_pages = []
+        obs = list(get_nuc_for_accs(accs))
+        self.assertEqual(sorted(r[0] for r in obs), accs)
+        self.assertEqual(self.server.posted, ['A1.1', 'A2.1'])
+        self.assertEqual(self._checkpointed_pages(), 0)
+
+    def test_get_rate_limited(self):
+        list(get_nuc_for_query('anything', entrez_delay=0.05))
+        times = [t for _, _, t in self.server.log]
+        self.assertEqual(len(times), 5)
+        # requests are concurrent, but never sent faster than the rate limit
+        self.assertGreaterEqual(times[-1] - times[0], 4 * 0.05 * 0.9)
+
+    def test_get_api_key(self):
+        os.environ['NCBI_API_KEY'] = 'my-key'
+        list(get_nuc_for_query('anything'))
+        self.assertTrue(all(p['api_key'] == ['my-key']
+                            for _, p, _ in self.server.log))
+
+
+class TestTokenBucket(TestPluginBase):
+    package = 'rescript.tests'
+
+    def test_token_bucket(self):
+        bucket = _TokenBucket(rate=50)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 5 / 50 * 0.9)
+
+    def test_token_bucket_threads(self):
+        bucket = _TokenBucket(rate=50)
+        times = []
+        threads = [threading.Thread(
+            target=lambda: (bucket.acquire(), times.append(time.monotonic())))
+            for _ in range(6)]
+        start = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(max(times) - start, 5 / 50 * 0.9)
+
+    def test_get_rate_limiter(self):
+        with patch.dict(os.environ):
+            os.environ.pop('NCBI_API_KEY', None)
+            self.assertEqual(_get_rate_limiter().rate, 3)
+            self.assertEqual(_get_rate_limiter(1.).rate, 1)
+            self.assertEqual(_get_rate_limiter(0).rate, 3)
+            os.environ['NCBI_API_KEY'] = 'my-key'
+            self.assertEqual(_get_rate_limiter().rate, 10)
+            self.assertEqual(_get_rate_limiter(None).rate, 10)
+            self.assertEqual(_get_rate_limiter(0.334).rate, 1 / 0.334)
+
+
+class TestParseRecords(TestPluginBase):
+    package = 'rescript.tests'
+
+    def test_parse_records_tseq(self):
+        xml = ('<?xml version="1.0" encoding="UTF-8" ?>\n'
+               '<!DOCTYPE TSeqSet PUBLIC "-//NCBI//NCBI TSeq/EN" '
+               '"https://www.ncbi.nlm.nih.gov/dtd/NCBI_TSeq.dtd">\n'
+               '<TSeqSet>\n' + _TSEQ.format('A1.1', '562', 'ACGT') + '\n' +
+               _TSEQ.format('A2.1', '1423', 'GG') + '\n</TSeqSet>')
+        obs = list(_parse_records(io.BytesIO(xml.encode())))
+        self.assertEqual(obs, [
+            {'TSeq_seqtype': None, 'TSeq_accver': 'A1.1',
+             'TSeq_taxid': '562', 'TSeq_sequence': 'ACGT'},
+            {'TSeq_seqtype': None, 'TSeq_accver': 'A2.1',
+             'TSeq_taxid': '1423', 'TSeq_sequence': 'GG'}])
+
+    def test_parse_records_taxon(self):
+        xml = '<TaxaSet>{0}</TaxaSet>'.format(_TAXON.format(
+            '1423', 'Bacillus subtilis', 'Bacteria',
+            _LINEAGE_TAXON.format('genus', 'Bacillus')))
+        obs, = _parse_records(io.BytesIO(xml.encode()))
+        self.assertEqual(obs, {
+            'TaxId': '1423', 'ScientificName': 'Bacillus subtilis',
+            'GeneticCode': {'GCId': '11'}, 'Division': 'Bacteria',
+            'LineageEx': [{'TaxId': '0', 'ScientificName': 'Bacillus',
+                           'Rank': 'genus'}]})
+
+    def test_parse_records_empty(self):
+        obs = list(_parse_records(io.BytesIO(b'<TSeqSet>\n</TSeqSet>')))
+        self.assertEqual(obs, [])
@@ -6,10 +6,16 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
+import os
 import qiime2
 import pkg_resources
+from collections import OrderedDict
+from unittest.mock import patch
 from qiime2.plugin.testing import TestPluginBase
+from q2_types.tree import NewickFormat
+from rescript.types._format import SILVATaxonomyFormat, SILVATaxidMapFormat
 from rescript.parse_silva_taxonomy import (parse_silva_taxonomy,
+                                           _parse_silva_taxonomy,
                                            _keep_allowed_chars, _prep_taxranks,
                                            _prep_taxmap, ALLOWED_RANKS,
                                            SELECTED_RANKS,
@@ -44,15 +50,18 @@ class TestParseSilvaTaxonomy(TestPluginBase):
                                                   'data/silva_taxa.tsv')
         tr = qiime2.Artifact.import_data('FeatureData[SILVATaxonomy]', tr_path)
         self.taxranks = tr.view(pd.DataFrame)
+        self.taxranks_fmt = tr.view(SILVATaxonomyFormat)
         # silva taxonomy tree file 1
         tt = qiime2.Artifact.import_data(
             'Phylogeny[Rooted]', self.get_data_path('taxid_tree.tre'))
         self.taxtree = tt.view(TreeNode)
+        self.taxtree_fmt = tt.view(NewickFormat)
         # taxonomy mapping file 2
         tm2 = qiime2.Artifact.import_data(
             'FeatureData[SILVATaxidMap]',
             self.get_data_path('taxmap_test_match_tree.txt'))
         self.taxmap2 = tm2.view(pd.DataFrame)
+        self.taxmap2_fmt = tm2.view(SILVATaxidMapFormat)
         # taxonomy tree file with missing taxid:
         tt2 = qiime2.Artifact.import_data(
             'Phylogeny[Rooted]',
@@ -209,6 +218,24 @@ class TestParseSilvaTaxonomy(TestPluginBase):
         exp_taxonomy.sort_index(inplace=True)
         assert_frame_equal(obs_taxonomy, exp_taxonomy)
 
+    def test_build_base_silva_taxonomy_repeated_rank(self):
+        # if a rank occurs more than once in a lineage, the upper-level
+        # taxonomy is kept, and ranks that are not allowed are skipped
+        tree = TreeNode.read(['((((5)4)3)2)1;'])
+        taxranks = pd.DataFrame(
+            {1: ['2', '3', '4', '5'],
+             2: ['domain', 'phylum', 'major_clade', 'phylum']},
+            index=['Bacteria;', 'Bacteria;Phylum1;', 'Bacteria;Phylum1;MC;',
+                   'Bacteria;Phylum1;MC;Phylum2;'])
+        obs = _build_base_silva_taxonomy(
+            tree, _prep_taxranks(taxranks),
+            OrderedDict([('domain', 'd__'), ('phylum', 'p__')]))
+        exp = pd.DataFrame({'d__': ['Bacteria'] * 4,
+                            'p__': ['Phylum1', 'Phylum1', 'Phylum1',
+                                    'Bacteria']},
+                           index=pd.Index(['5', '4', '3', '2'], name='taxid'))
+        assert_frame_equal(obs, exp)
+
     def test_compile_taxonomy_output_default(self):
         input_taxrank = _prep_taxranks(self.taxranks)
         silva_tax = _build_base_silva_taxonomy(self.taxtree, input_taxrank,
@@ -254,9 +281,9 @@ class TestParseSilvaTaxonomy(TestPluginBase):
                           input_taxrank, input_taxmap, self.taxtree)
 
     def test_parse_silva_taxonomy(self):
-        obs_res = parse_silva_taxonomy(self.taxtree, self.taxmap2,
-                                       self.taxranks,
-                                       include_species_labels=True)
+        obs_res = _parse_silva_taxonomy(self.taxtree, self.taxmap2,
+                                        self.taxranks,
+                                        include_species_labels=True)
         obs_res.sort_index(inplace=True)
         # expected:
         t1 = ("d__Archaea; p__Aenigmarchaeota; c__Aenigmarchaeia; "
@@ -267,3 +294,27 @@ class TestParseSilvaTaxonomy(TestPluginBase):
         exp_res.index.name = 'Feature ID'
         exp_res.sort_index(inplace=True)
         assert_series_equal(obs_res, exp_res)
+
+    def test_parse_silva_taxonomy_cached(self):
+        cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        args = [self.taxtree_fmt, self.taxmap2_fmt, self.taxranks_fmt]
+        with patch.dict(os.environ, {'RESCRIPT_CACHE_DIR': cache_dir}):
+            exp = parse_silva_taxonomy(*args)
+            assert_series_equal(exp, _parse_silva_taxonomy(
+                self.taxtree, self.taxmap2, self.taxranks))
+            cached = os.path.join(cache_dir, 'silva-taxonomy')
+            self.assertEqual(len(os.listdir(cached)), 1)
+            # the parsed taxonomy is reused from the cache on the next run
+            with patch('rescript.parse_silva_taxonomy._parse_silva_taxonomy'
+                       ) as parse:
+                obs = parse_silva_taxonomy(*args)
+                parse.assert_not_called()
+            assert_series_equal(obs, exp)
+            # but not if different options are used
+            obs = parse_silva_taxonomy(*args, include_species_labels=True)
+            self.assertTrue(obs.str.contains('s__').all())
+            self.assertEqual(len(os.listdir(cached)), 2)
+            # or by a different version of RESCRIPt
+            with patch('rescript.__version__', 'another version'):
+                parse_silva_taxonomy(*args)
+            self.assertEqual(len(os.listdir(cached)), 3)
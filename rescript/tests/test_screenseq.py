@@ -8,10 +8,15 @@
 
 
 import qiime2
+import skbio
+import numpy as np
+from unittest.mock import patch
 from qiime2.plugin.testing import TestPluginBase
 from q2_types.feature_data import DNAFASTAFormat, DNAIterator
 
-from rescript.screenseq import cull_seqs
+from rescript.screenseq import (cull_seqs, _screen_batch,
+                                _filt_seq_with_degenerates,
+                                _filter_homopolymer)
 from rescript.types._format import RNAFASTAFormat
 
 
@@ -24,7 +29,7 @@ class TestCleanseq(TestPluginBase):
     def setUp(self):
         super().setUp()
         input_fp = self.get_data_path('cleanseq-test-1.fasta')
-        self.seqs1 = DNAFASTAFormat(input_fp, mode='r').view(DNAIterator)
+        self.seqs1 = DNAFASTAFormat(input_fp, mode='r')
 
     def test_cull_seqs_default_params(self):
         # Test default params: num_degenerates = 5, homopolymer_length = 8
@@ -36,7 +41,7 @@ class TestCleanseq(TestPluginBase):
     def test_cull_seqs_rna_default_params(self):
         # Test default params work with RNA seqs as input
         rna_path = self.get_data_path('cleanseq-test-1-rna.fasta')
-        rna_seqs = RNAFASTAFormat(rna_path, mode='r').view(DNAIterator)
+        rna_seqs = RNAFASTAFormat(rna_path, mode='r').view(DNAFASTAFormat)
         obs = cull_seqs(rna_seqs)
         obs_ids = {seq.metadata['id'] for seq in obs.view(DNAIterator)}
         exp_ids = {'Ambig2', 'cleanseq'}
@@ -65,3 +70,67 @@ class TestCleanseq(TestPluginBase):
         obs_ids = {seq.metadata['id'] for seq in obs.view(DNAIterator)}
         exp_ids = {'Hpoly8', 'cleanseq'}
         self.assertEqual(obs_ids, exp_ids)
+
+    def test_cull_seqs_skbio_engine(self):
+        obs = cull_seqs(self.seqs1, num_degenerates=7, homopolymer_length=7,
+                        engine='skbio')
+        obs_ids = {seq.metadata['id'] for seq in obs.view(DNAIterator)}
+        exp_ids = {'Ambig2', 'Ambig6', 'cleanseq'}
+        self.assertEqual(obs_ids, exp_ids)
+
+    def test_cull_seqs_engines_match(self):
+        input_fp = self.get_data_path('cleanseq-test-1.fasta')
+        for degen, hpoly in [(1, 2), (1, 9), (5, 8), (7, 7), (7, 9)]:
+            obs = {}
+            for engine in ['vectorized', 'skbio']:
+                seqs = DNAFASTAFormat(input_fp, mode='r')
+                result = cull_seqs(seqs, degen, hpoly, engine=engine)
+                with open(str(result)) as fh:
+                    obs[engine] = fh.read()
+            self.assertEqual(obs['vectorized'], obs['skbio'])
+
+    def test_screen_batch_matches_per_sequence_screen(self):
+        rng = np.random.RandomState(0)
+        alphabet = np.array(list('ACGTACGTACGTNRYKM'))
+        # short, low-complexity sequences yield plenty of homopolymers and
+        # degenerates, including at record boundaries; empty seqs included
+        seqs = [skbio.DNA(''.join(
+            rng.choice(alphabet[:rng.randint(1, 18)], rng.randint(0, 40))))
+            for i in range(500)]
+        for degen, hpoly in [(1, 2), (2, 3), (3, 5), (5, 8)]:
+            obs = _screen_batch([s.values.tobytes() for s in seqs],
+                                degen, hpoly)
+            exp = [not (_filt_seq_with_degenerates(s, degen) or
+                        _filter_homopolymer(s, hpoly)) for s in seqs]
+            self.assertEqual(obs.tolist(), exp)
+
+    def test_cull_seqs_preserves_records(self):
+        # records that pass are written out unchanged
+        input_fp = self.get_data_path('cleanseq-test-1.fasta')
+        exp = {seq.metadata['id']: seq for seq in
+               DNAFASTAFormat(input_fp, mode='r').view(DNAIterator)}
+        obs = cull_seqs(self.seqs1, num_degenerates=7, homopolymer_length=9)
+        obs = list(obs.view(DNAIterator))
+        self.assertEqual(len(obs), 5)
+        for seq in obs:
+            self.assertEqual(seq, exp[seq.metadata['id']])
+
+    def test_screen_batch_empty(self):
+        self.assertEqual(_screen_batch([], 5, 8).tolist(), [])
+        self.assertEqual(_screen_batch([b''], 5, 8).tolist(), [True])
+
+    def test_cull_seqs_threads(self):
+        input_fp = self.get_data_path('cleanseq-test-1.fasta')
+        exp = cull_seqs(DNAFASTAFormat(input_fp, mode='r'),
+                        num_degenerates=7, homopolymer_length=7)
+        with open(str(exp)) as fh:
+            exp = fh.read()
+        # use tiny chunks so that records are spread across workers
+        with patch('rescript.screenseq._SCREEN_CHUNK_SIZE', 100):
+            for engine in ['vectorized', 'skbio']:
+                seqs = DNAFASTAFormat(input_fp, mode='r')
+                obs = cull_seqs(seqs, num_degenerates=7, homopolymer_length=7,
+                                engine=engine, threads=2)
+                with open(str(obs)) as fh:
+                    # records are written back in their original order
+                    self.assertEqual(fh.read(), exp)
@@ -0,0 +1,213 @@
+# ----------------------------------------------------------------------------
+# Copyright (c) 2020, QIIME 2 development team.
+#
+# Distributed under the terms of the Modified BSD License.
+#
+# The full license is in the file LICENSE, distributed with this software.
+# ----------------------------------------------------------------------------
+
+import os
+import time
+from unittest.mock import patch
+
+import pandas as pd
+import skbio
+from qiime2.plugin.testing import TestPluginBase
+
+from rescript._utilities import (_get_cache_dir, _read_fasta_records,
+                                 _read_fasta_chunks, _parse_fasta_lines,
+                                 _save_cached_series, _load_cached_series,
+                                 _list_cache_entries, _evict_cache,
+                                 _cache_path, _rna_to_dna, _read_dna_fasta,
+                                 _rna_to_dna_iterator)
+
+
+class TestFastaRecords(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.env = patch.dict(
+            os.environ, {'RESCRIPT_CACHE_DIR': self.cache_dir})
+        self.env.start()
+        self.fasta_fp = os.path.join(self.temp_dir.name, 'seqs.fasta')
+        with open(self.fasta_fp, 'w') as fasta:
+            fasta.write('>s1 a description\nACGT\nACGT\n'
+                        '>s2\nGGGG\n'
+                        '>s3\tanother one\nTTTT\nAA\n'
+                        '>s4\nCCCC\n')
+
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
+    def test_get_cache_dir(self):
+        obs = _get_cache_dir('a', 'b')
+        self.assertEqual(obs, os.path.join(self.cache_dir, 'a', 'b'))
+        self.assertTrue(os.path.isdir(obs))
+
+    def test_read_fasta_records_whitespace_in_sequence(self):
+        with open(self.fasta_fp, 'w') as fasta:
+            fasta.write('>s1\nAC GT\n  GG A \n')
+        exp = [(b's1', b'ACGTGGA')]
+        self.assertEqual(list(_read_fasta_records(self.fasta_fp)), exp)
+
+    def test_read_fasta_records_tab_in_sequence(self):
+        # as by skbio, only spaces are dropped from within sequences
+        with open(self.fasta_fp, 'w') as fasta:
+            fasta.write('>s1\n\tAC\tGT\t\n')
+        exp = [(b's1', b'AC\tGT')]
+        self.assertEqual(list(_read_fasta_records(self.fasta_fp)), exp)
+
+    def test_read_fasta_chunks(self):
+        with open(self.fasta_fp, 'rb') as fasta:
+            exp = fasta.read()
+        for chunk_size in [1, 5, 28, 1000]:
+            obs = list(_read_fasta_chunks(self.fasta_fp, chunk_size))
+            self.assertEqual(b''.join(obs), exp)
+            # each chunk holds whole records only
+            for chunk in obs:
+                self.assertTrue(chunk.startswith(b'>'))
+                self.assertTrue(chunk.endswith(b'\n'))
+            records = [r for chunk in obs
+                       for r in _parse_fasta_lines(chunk.splitlines())]
+            self.assertEqual(records, list(_read_fasta_records(self.fasta_fp)))
+
+
+class TestCache(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = os.path.join(self.temp_dir.name, 'cache')
+        self.env = patch.dict(
+            os.environ, {'RESCRIPT_CACHE_DIR': self.cache_dir})
+        self.env.start()
+        self.series = pd.Series(['k__Bacteria; p__Firmicutes', 'k__Archaea',
+                                 'k__Bacteria; p__Firmicutes'],
+                                index=['a', 'b', 'c'])
+
+    def tearDown(self):
+        self.env.stop()
+        super().tearDown()
+
+    def test_save_load_cached_series(self):
+        self.assertIsNone(_load_cached_series('silva-taxonomy', 'key'))
+        _save_cached_series('silva-taxonomy', 'key', self.series)
+        obs = _load_cached_series('silva-taxonomy', 'key')
+        pd.testing.assert_series_equal(obs, self.series)
+        self.assertEqual(list(_list_cache_entries()['entry']),
+                         [os.path.join('silva-taxonomy', 'key.npz')])
+
+    def test_load_cached_series_corrupt_entry(self):
+        with open(_cache_path('silva-taxonomy', 'key.npz'), 'w') as fh:
+            fh.write('not a cache entry')
+        self.assertIsNone(_load_cached_series('silva-taxonomy', 'key'))
+
+    def test_evict_cache(self):
+        for i, key in enumerate(['old', 'mid', 'new']):
+            _save_cached_series('silva-taxonomy', key, self.series)
+            path = _cache_path('silva-taxonomy', key + '.npz')
+            os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+        # using an entry makes it the most recently used
+        _load_cached_series('silva-taxonomy', 'old')
+        entries = _list_cache_entries()
+        self.assertEqual(
+            list(entries['entry']),
+            [os.path.join('silva-taxonomy', k + '.npz')
+             for k in ['old', 'new', 'mid']])
+        size = entries['size'].iloc[0]
+        obs = _evict_cache(max_size=size * 2)
+        self.assertEqual(obs, [os.path.join('silva-taxonomy', 'mid.npz')])
+        self.assertIsNone(_load_cached_series('silva-taxonomy', 'mid'))
+        self.assertIsNotNone(_load_cached_series('silva-taxonomy', 'new'))
+
+    def test_evict_cache_only_cache_namespaces(self):
+        # files managed by other actions are neither listed nor evicted
+        others = [os.path.join('ncbi', 'checkpoints.sqlite'),
+                  os.path.join('silva-downloads', 'taxmap.txt.gz.part')]
+        for other in others:
+            os.makedirs(os.path.join(self.cache_dir, os.path.dirname(other)),
+                        exist_ok=True)
+            with open(os.path.join(self.cache_dir, other), 'w') as fh:
+                fh.write('not a cache entry')
+        _save_cached_series('silva-taxonomy', 'key', self.series)
+        self.assertEqual(list(_list_cache_entries()['entry']),
+                         [os.path.join('silva-taxonomy', 'key.npz')])
+        self.assertEqual(_evict_cache(max_size=0),
+                         [os.path.join('silva-taxonomy', 'key.npz')])
+        for other in others:
+            self.assertTrue(
+                os.path.exists(os.path.join(self.cache_dir, other)))
+
+    def test_cache_path_unknown_namespace(self):
+        with self.assertRaisesRegex(ValueError, 'Unknown cache namespace'):
+            _cache_path('test', 'key.npz')
+
+    def test_write_cache_entry_evicts(self):
+        with patch.dict(os.environ, {'RESCRIPT_CACHE_MAX_SIZE': '0'}):
+            _save_cached_series('silva-taxonomy', 'key', self.series)
+        self.assertEqual(len(_list_cache_entries()), 0)
+
+
+class TestRNAToDNA(TestPluginBase):
+    package = 'rescript.tests'
+
+    def setUp(self):
+        super().setUp()
+        self.rna_fp = os.path.join(self.temp_dir.name, 'rna.fasta')
+
+    def _write_rna(self, data):
+        with open(self.rna_fp, 'w') as fasta:
+            fasta.write(data)
+
+    def test_rna_to_dna(self):
+        self._write_rna('>s1 a description\nACGU\nUUGA\n'
+                        '>s2\nRYSWKMBDHVN-.U\n'
+                        '>s3\tanother one\nGGGG\n')
+        obs = _rna_to_dna(self.rna_fp)
+        with open(str(obs)) as fh:
+            self.assertEqual(fh.read(),
+                             '>s1 a description\nACGTTTGA\n'
+                             '>s2\nRYSWKMBDHVN-.T\n'
+                             '>s3 another one\nGGGG\n')
+        # output matches reverse transcription with skbio
+        exp = [s.reverse_transcribe() for s in skbio.read(
+            self.rna_fp, format='fasta', constructor=skbio.RNA)]
+        self.assertEqual(list(_read_dna_fasta(str(obs))), exp)
+
+    def test_rna_to_dna_whitespace_in_sequence(self):
+        self._write_rna('>a\nAC GU\n  UU \n>b\nA U\n')
+        obs = _rna_to_dna(self.rna_fp)
+        with open(str(obs)) as fh:
+            self.assertEqual(fh.read(), '>a\nACGTTT\n>b\nAT\n')
+
+    def test_rna_to_dna_batches(self):
+        self._write_rna('>s1\nACGU\n>s2\nUUUU\n>s3\nUA\n')
+        with patch('rescript._utilities._RNA_TO_DNA_BATCH_SIZE', 2):
+            obs = _rna_to_dna(self.rna_fp)
+        with open(str(obs)) as fh:
+            self.assertEqual(fh.read(), '>s1\nACGT\n>s2\nTTTT\n>s3\nTA\n')
+
+    def test_rna_to_dna_invalid_characters(self):
+        for seq in ['ACGT', 'acgu', 'ACGU*', 'AC\tGU']:
+            self._write_rna('>s1\nACGU\n>s2\n{0}\n'.format(seq))
+            with self.assertRaisesRegex(ValueError, 'sequence s2'):
+                _rna_to_dna(self.rna_fp)
+
+    def test_rna_to_dna_iterator(self):
+        self._write_rna('>s1 a description\nACGU\nUUGA\n'
+                        '>s2\nRYSWKMBDHVN-.U\n')
+        exp = [s.reverse_transcribe() for s in skbio.read(
+            self.rna_fp, format='fasta', constructor=skbio.RNA)]
+        self.assertEqual(list(_rna_to_dna_iterator(self.rna_fp)), exp)
+
+    def test_rna_to_dna_iterator_is_lazy(self):
+        self._write_rna('>s1\nACGU\n>s2\nACGT\n')
+        with patch('rescript._utilities._RNA_TO_DNA_BATCH_SIZE', 1):
+            obs = _rna_to_dna_iterator(self.rna_fp)
+            self.assertEqual(str(next(obs)), 'ACGT')
+            # invalid records are only detected once they are reached
+            with self.assertRaisesRegex(ValueError, 'sequence s2'):
+                next(obs)
@@ -6,12 +6,10 @@
 # The full license is in the file LICENSE, distributed with this software.
 # ----------------------------------------------------------------------------
 
-import itertools
-
 import qiime2.plugin.model as model
 from qiime2.plugin import ValidationError
 
-from rescript._utilities import _read_rna_fasta
+from rescript._utilities import _RNA_CHARS
 
 
 def _validate_record_len(cells, current_line_number, exp_len):
@@ -47,6 +45,13 @@ def _validate_silva_taxonomy_format(inputvalue, columnnumber):
             "string with a terminal semicolon.".format(columnnumber))
 
 
+def _validate_has_sequence(has_seq, line_number):
+    if not has_seq:
+        raise ValidationError(
+            'Found header without sequence data at line {0}.'.format(
+                line_number))
+
+
 class SILVATaxonomyFormat(model.TextFileFormat):
     def _validate(self, n_records=None):
         with self.open() as fh:
@@ -132,12 +137,46 @@ SILVATaxidMapDirectoryFormat = model.SingleFileDirectoryFormat(
 
 class RNAFASTAFormat(model.TextFileFormat):
     def _validate(self, n_records=None):
-        generator = _read_rna_fasta(str(self))
-        if n_records is not None:
-            generator = itertools.islice(generator, n_records)
-        # just loop over contents with skbio generator
-        # skbio will raise an error if any record is not an RNA sequence
-        [i for i in generator]
+        # stream over the raw lines instead of loading skbio objects, but
+        # apply the same FASTA rules as skbio
+        record_count = header_line = 0
+        has_seq = True
+        blank_line = False
+        # spaces within sequences are ignored, as by skbio (other whitespace,
+        # e.g. tabs, is invalid)
+        valid_chars = _RNA_CHARS + b' '
+        with open(str(self), 'rb') as fh:
+            for line_number, line in enumerate(fh, start=1):
+                line = line.strip()
+                if line.startswith(b'>'):
+                    _validate_has_sequence(has_seq, header_line)
+                    if n_records is not None and record_count >= n_records:
+                        return
+                    record_count += 1
+                    header_line = line_number
+                    has_seq = False
+                    blank_line = False
+                elif not line:
+                    blank_line = True
+                else:
+                    if record_count == 0:
+                        raise ValidationError(
+                            'Found non-header line before the first header '
+                            'line, at line {0}.'.format(line_number))
+                    if blank_line:
+                        raise ValidationError(
+                            'Found blank or whitespace-only line within '
+                            'record, before line {0}.'.format(line_number))
+                    invalid = line.translate(None, valid_chars)
+                    if invalid:
+                        raise ValidationError(
+                            'Invalid character(s) in sequence at line {0}: '
+                            '{1}. Valid RNA characters: {2}'.format(
+                                line_number,
+                                sorted(set(invalid.decode(errors='replace'))),
+                                sorted(_RNA_CHARS.decode())))
+                    has_seq = True
+        _validate_has_sequence(has_seq, header_line)
 
     def _validate_(self, level):
         record_count_map = {'min': 5, 'max': None}
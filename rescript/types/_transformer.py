@@ -11,7 +11,7 @@ from q2_types.feature_data import DNAFASTAFormat, DNAIterator
 
 from ..plugin_setup import plugin
 from ._format import SILVATaxonomyFormat, SILVATaxidMapFormat, RNAFASTAFormat
-from rescript._utilities import _rna_to_dna, _read_dna_fasta
+from rescript._utilities import _rna_to_dna, _rna_to_dna_iterator
 
 
 def _read_dataframe(fh, header=0):
@@ -62,6 +62,5 @@ def _6(data: RNAFASTAFormat) -> DNAFASTAFormat:
 
 @plugin.register_transformer
 def _7(data: RNAFASTAFormat) -> DNAIterator:
-    converted_dna = _rna_to_dna(str(data))
-    generator = _read_dna_fasta(str(converted_dna))
+    generator = _rna_to_dna_iterator(str(data))
     return DNAIterator(generator)
@@ -221,10 +221,49 @@ class TestRNAFASTAFormat(RescriptTypesTestPluginBase):
     def test_rna_fasta_format_validate_negative_is_dna(self):
         filepath = pkg_resources.resource_filename(
             'rescript.tests', 'data/derep-test.fasta')
-        with self.assertRaisesRegex(ValueError, 'Invalid character.*\'T\''):
+        with self.assertRaisesRegex(
+                ValidationError, 'Invalid character.*\'T\''):
             format = RNAFASTAFormat(filepath, mode='r')
             format.validate('min')
 
+    def _validate_rna_fasta(self, data, level='max'):
+        filepath = os.path.join(self.temp_dir.name, 'rna.fasta')
+        with open(filepath, 'w') as fasta:
+            fasta.write(data)
+        RNAFASTAFormat(filepath, mode='r').validate(level)
+
+    def test_rna_fasta_format_validate_skbio_leniency(self):
+        # blank lines between records and spaces within sequences are
+        # accepted, as by skbio
+        self._validate_rna_fasta('\n>a desc\nAC GU\n  UU\n\n>b\nA\n\n')
+        self._validate_rna_fasta('')
+
+    def test_rna_fasta_format_validate_negative_tab_in_sequence(self):
+        # skbio only ignores spaces within sequences
+        with self.assertRaisesRegex(ValidationError, r"line 2.*'\\t'"):
+            self._validate_rna_fasta('> d\nAC\tGU\n')
+
+    def test_rna_fasta_format_validate_negative_header_without_sequence(self):
+        with self.assertRaisesRegex(ValidationError, 'without sequence.*1'):
+            self._validate_rna_fasta('>a\n>b\nACGU\n')
+        with self.assertRaisesRegex(ValidationError, 'without sequence.*3'):
+            self._validate_rna_fasta('>a\nACGU\n>b\n')
+
+    def test_rna_fasta_format_validate_negative_no_header(self):
+        with self.assertRaisesRegex(ValidationError, 'non-header line'):
+            self._validate_rna_fasta('ACGU\n>a\nACGU\n')
+
+    def test_rna_fasta_format_validate_negative_blank_line_in_record(self):
+        with self.assertRaisesRegex(ValidationError, 'blank.*line 4'):
+            self._validate_rna_fasta('>a\nAC\n\nGU\n')
+
+    def test_rna_fasta_format_validate_min_level(self):
+        data = ''.join('>s{0}\nACGU\n'.format(i) for i in range(5))
+        # only the first 5 records are validated at level 'min'
+        self._validate_rna_fasta(data + '>bad\nACGT\n', level='min')
+        with self.assertRaisesRegex(ValidationError, 'line 12'):
+            self._validate_rna_fasta(data + '>bad\nACGT\n')
+
 
 class TestRNATransformers(RescriptTypesTestPluginBase):
 